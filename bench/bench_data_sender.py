@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# bench_data_sender.py
+# Copyright (C) ContinuumBridge Limited, 2015 - All Rights Reserved
+#
+""" Runs data_sender.py off-bridge against synthetic or recorded adaptor traffic.
+
+    Stand-ins for cbcommslib, cbconfig and the twisted reactor are installed before
+    data_sender is imported. Time is simulated: data_sender's time.time() follows a
+    clock that the benchmark advances from message to message, and reactor.callLater
+    calls are run when the clock reaches them. Reports messages/sec, p50/p99 time per
+    onAdaptorData call and bytes sent to the client, and with --memory, peak memory
+    as traced by tracemalloc (which slows everything else down). With --allocations,
+    keeps every series name handed to the router and reports how many distinct name
+    objects were made per sample beyond one per series.
+
+    Examples:
+        python bench/bench_data_sender.py --devices 100 --characteristics temperature,acceleration --rate 50
+        python bench/bench_data_sender.py --devices 10 --duration 60 --record traffic.jsonl
+        python bench/bench_data_sender.py --replay traffic.jsonl
+        python bench/bench_data_sender.py --duration 3600 --reannounce 10 --memory
+        python bench/bench_data_sender.py --devices 200 --characteristics acceleration,gyro,magnetometer --rate 10 --workers 4
+        python bench/bench_data_sender.py --devices 500 --duration 600 --step 0.01 --restart 300
+        python bench/bench_data_sender.py --devices 1 --characteristics acceleration --rate 50 --allocations
+"""
+
+import sys
+import os
+import gc
+import json
+import heapq
+import random
+import shutil
+import tempfile
+import argparse
+import logging
+import time as _time
+import types
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+class Clock:
+    """ Simulated wall clock, standing in for the time module inside data_sender """
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(_time, name)
+
+class DelayedCall:
+    def __init__(self, when, seq, f, args, kwargs):
+        self.when = when
+        self.seq = seq
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor:
+    """ Just enough of the twisted reactor for data_sender, driven by Clock """
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = []
+        self.seq = 0
+
+    def callLater(self, delay, f, *args, **kwargs):
+        self.seq += 1
+        call = DelayedCall(self.clock.now + delay, self.seq, f, args, kwargs)
+        heapq.heappush(self.calls, call)
+        return call
+
+    def advance(self, to):
+        """ Runs everything due up to time to, then sets the clock to it """
+        while self.calls and self.calls[0].when <= to:
+            call = heapq.heappop(self.calls)
+            if call.cancelled:
+                continue
+            self.clock.now = max(self.clock.now, call.when)
+            call.called = True
+            call.f(*call.args, **call.kwargs)
+        self.clock.now = max(self.clock.now, to)
+
+class Deferred:
+    """ The result of a call made straight away rather than in a thread """
+    def __init__(self, f, args, kwargs):
+        try:
+            self.result = f(*args, **kwargs)
+            self.failed = False
+        except Exception as ex:
+            self.result = Failure(ex)
+            self.failed = True
+
+    def addErrback(self, f, *args):
+        if self.failed:
+            self.result = f(self.result, *args)
+            self.failed = False
+        return self
+
+    def addCallback(self, f, *args):
+        if not self.failed:
+            self.result = f(self.result, *args)
+        return self
+
+class Failure:
+    def __init__(self, ex):
+        self.ex = ex
+
+    def getErrorMessage(self):
+        return str(self.ex)
+
+class CbApp(object):
+    def __init__(self, argv):
+        self.id = "AID0"
+        self.bridge_id = "BID0"
+        self.adtInstances = []
+        self.adaptorMessages = 0
+
+    def cbLog(self, level, message):
+        logging.log(data_sender.LOG_LEVELS.get(level, logging.INFO), "%s %s", self.id, message)
+
+    def sendMessage(self, msg, destination):
+        self.adaptorMessages += 1
+
+    def sendManagerMessage(self, msg):
+        pass
+
+class CbClient(object):
+    """ Acknowledges everything at once and counts what is sent """
+    def __init__(self, aid, cid, keep=50):
+        self.aid = aid
+        self.cid = cid
+        self.messages = []
+        self.sent = 0
+        self.bytes = 0
+        self.points = 0
+
+    def send(self, msg):
+        self.sent += 1
+        self.bytes += len(json.dumps(msg))
+        if isinstance(msg.get("d"), list):
+            self.points += sum(len(series.get("points", [])) for series in msg["d"])
+
+    def receive(self, message):
+        pass
+
+    def save(self):
+        pass
+
+    def loadSaved(self):
+        pass
+
+def install(configDir, clock):
+    """ Installs the stand-in modules and imports data_sender """
+    global data_sender
+    cbcommslib = types.ModuleType("cbcommslib")
+    cbcommslib.CbApp = CbApp
+    cbcommslib.CbClient = CbClient
+    cbconfig = types.ModuleType("cbconfig")
+    cbconfig.CB_CONFIG_DIR = configDir
+    cbconfig.__all__ = ["CB_CONFIG_DIR"]
+    reactor = Reactor(clock)
+    twisted = types.ModuleType("twisted")
+    internet = types.ModuleType("twisted.internet")
+    threads = types.ModuleType("twisted.internet.threads")
+    threads.deferToThread = lambda f, *args, **kwargs: Deferred(f, args, kwargs)
+    internet.reactor = reactor
+    internet.threads = threads
+    twisted.internet = internet
+    modules = {"cbcommslib": cbcommslib, "cbconfig": cbconfig, "twisted": twisted,
+               "twisted.internet": internet, "twisted.internet.reactor": reactor,
+               "twisted.internet.threads": threads}
+    if "requests" not in sys.modules:
+        try:
+            import requests
+        except ImportError:
+            modules["requests"] = types.ModuleType("requests")
+    sys.modules.update(modules)
+    import data_sender
+    data_sender.time = clock
+    return data_sender, reactor
+
+CHARACTERISTICS = {
+    "temperature": lambda v: round(v, 2),
+    "ir_temperature": lambda v: round(v, 2),
+    "humidity": lambda v: round(v, 1),
+    "luminance": lambda v: round(abs(v)*20, 0),
+    "power": lambda v: round(abs(v)*10, 1),
+    "battery": lambda v: round(min(abs(v), 100), 0),
+    "binary_sensor": lambda v: "on" if v > 0 else "off",
+    "connected": lambda v: v > -3,
+    "acceleration": lambda v: {"x": round(v/10, 3), "y": round(-v/10, 3), "z": round(1 + v/20, 3)},
+    "gyro": lambda v: {"x": round(v, 2), "y": round(v/2, 2), "z": round(-v, 2)},
+    "magnetometer": lambda v: {"x": round(v*3, 1), "y": round(v*2, 1), "z": round(v, 1)}
+}
+
+# Config keys that enable characteristics that are off by default
+ENABLE = {"acceleration": "accel", "gyro": "gyro", "magnetometer": "magnet",
+          "ir_temperature": "irtemperature", "buttons": "buttons"}
+
+def generate(devices, characteristics, rate, duration, start, seed, step=0.3):
+    """ Yields adaptor data messages, in time order, for every device and characteristic.
+        Each series is a random walk sampled at rate Hz, with the phase staggered per device
+        and steps of standard deviation step.
+    """
+    rnd = random.Random(seed)
+    series = []
+    for d in range(devices):
+        for c in characteristics:
+            series.append([start + rnd.random()/rate, "ADT%d" % d, c, rnd.gauss(0, 5)])
+    heapq.heapify(series)
+    end = start + duration
+    while series and series[0][0] < end:
+        s = series[0]
+        s[3] += rnd.gauss(0, step)
+        yield {"id": s[1], "characteristic": s[2], "data": CHARACTERISTICS[s[2]](s[3]), "timeStamp": s[0]}
+        s[0] += 1.0/rate
+        heapq.heapreplace(series, s)
+
+def replay(path):
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values)*p/100.0), len(values) - 1)]
+
+def run(args):
+    configDir = tempfile.mkdtemp(prefix="data_sender_bench")
+    try:
+        clock = Clock(args.start)
+        ds, reactor = install(configDir + os.sep, clock)
+        if args.workers:
+            ds.config["workers"] = args.workers
+        for item in args.config:
+            key, value = item.split("=", 1)
+            ds.config[key] = json.loads(value)
+        if args.replay:
+            messages = list(replay(args.replay))
+        else:
+            characteristics = args.characteristics.split(",")
+            messages = list(generate(args.devices, characteristics, args.rate, args.duration,
+                                     args.start, args.seed, args.step))
+        if args.record:
+            with open(args.record, 'w') as f:
+                for m in messages:
+                    f.write(json.dumps(m) + "\n")
+        adaptors = {}
+        for m in messages:
+            adaptors.setdefault(m["id"], set()).add(m["characteristic"])
+        for c in set(c for cs in adaptors.values() for c in cs):
+            if c in ENABLE:
+                ds.config[ENABLE[c]] = True
+        if messages:
+            clock.now = min(clock.now, messages[0]["timeStamp"])
+
+        traceMemory = args.memory and tracemalloc is not None
+        if traceMemory:
+            tracemalloc.start()
+        names = {}
+        stored = [0]
+        services = dict((a, {"id": a, "service": [{"characteristic": c} for c in sorted(adaptors[a])]})
+                        for a in adaptors)
+
+        def start():
+            """ Returns a configured app, with every adaptor's services announced, and how long that took """
+            began = _time.time()
+            app = ds.App([])
+            app.onConfigureMessage({"adaptors": [{"id": a, "name": a, "friendly_name": "Device " + a}
+                                                 for a in sorted(adaptors)]})
+            app.onConcMessage({"status": "ready"})
+            if args.allocations:
+                storeValues = app.router.storeValues
+                def countNames(name, timeStamp, value, characteristic):
+                    # Keeping the name stops its id being reused by a later one
+                    names[id(name)] = name
+                    stored[0] += 1
+                    storeValues(name, timeStamp, value, characteristic)
+                app.router.storeValues = countNames
+            for a in sorted(adaptors):
+                app.onAdaptorService(services[a])
+            return app, _time.time() - began
+
+        app, startup = start()
+        restart = clock.now + args.restart if args.restart else None
+        burstEnd = burst = restartTime = None
+
+        timer = getattr(_time, "perf_counter", _time.time)
+        latencies = []
+        gc.collect()
+        reannounce = clock.now + args.reannounce if args.reannounce else None
+        began = timer()
+        for m in messages:
+            if reannounce is not None and m["timeStamp"] >= reannounce:
+                # As adaptors do after reconnecting
+                for a in sorted(adaptors):
+                    app.onAdaptorService(services[a])
+                reannounce += args.reannounce
+            if restart is not None and m["timeStamp"] >= restart:
+                # As when the app is upgraded. The old app's timers run on, but it gets no more data.
+                app.onStop()
+                app, restartTime = start()
+                restart = None
+                burstEnd = clock.now + 60
+            if burstEnd is not None and m["timeStamp"] >= burstEnd:
+                burst = app.client.points
+                burstEnd = None
+            reactor.advance(m["timeStamp"])
+            t = timer()
+            app.onAdaptorData(m)
+            latencies.append(timer() - t)
+        reactor.advance(clock.now + 60)
+        if app.shards is not None:
+            # Wait for the workers to finish what they have been given
+            app.shards.stop()
+        elapsed = timer() - began
+        if traceMemory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        n = len(messages)
+        report = {"messages": n,
+                  "adaptors": len(adaptors),
+                  "startup_ms": startup*1000,
+                  "messages_per_sec": n/elapsed if elapsed else 0.0,
+                  "p50_us": percentile(latencies, 50)*1e6,
+                  "p99_us": percentile(latencies, 99)*1e6,
+                  "client_messages": app.client.sent,
+                  "bytes_sent": app.client.bytes,
+                  "dropped": app.dropped,
+                  "processors": len(app.processors)
+                 }
+        if traceMemory:
+            report["peak_memory_kb"] = peak/1024.0
+        if args.allocations:
+            series = len(set(names.values()))
+            report["stored_values"] = stored[0]
+            report["series"] = series
+            report["name_objects"] = len(names)
+            report["names_per_sample"] = float(len(names) - series)/n if n else 0.0
+        if args.restart:
+            report["restart_ms"] = restartTime*1000
+            report["restart_burst_points"] = burst
+        return report
+    finally:
+        shutil.rmtree(configDir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark data_sender.py with synthetic or recorded adaptor traffic")
+    parser.add_argument("--devices", type=int, default=50, help="number of adaptors")
+    parser.add_argument("--characteristics", default="temperature,humidity,acceleration",
+                        help="comma separated characteristics each adaptor offers")
+    parser.add_argument("--rate", type=float, default=1.0, help="samples per second per series")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of traffic to generate")
+    parser.add_argument("--step", type=float, default=0.3,
+                        help="standard deviation of each step of the random walks. Smaller is quieter")
+    parser.add_argument("--start", type=float, default=1.5e9, help="simulated start time")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", help="JSON lines file of adaptor data messages to replay")
+    parser.add_argument("--record", help="write the traffic to this JSON lines file")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=JSON",
+                        help="override a config value, eg: --config data_send_delay=5")
+    parser.add_argument("--reannounce", type=float, default=0,
+                        help="have every adaptor announce its services again every this many seconds")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run with this many worker processes. Worker time is not simulated")
+    parser.add_argument("--restart", type=float, default=0,
+                        help="restart the app after this many seconds and report the points sent in the minute after")
+    parser.add_argument("--memory", action="store_true", help="trace peak memory with tracemalloc")
+    parser.add_argument("--allocations", action="store_true",
+                        help="count the series name objects made per sample. Not with --workers")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.allocations and args.workers:
+        parser.error("--allocations needs the router in this process, so cannot be used with --workers")
+    logging.basicConfig(level=logging.ERROR)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        for key in sorted(report):
+            value = report[key]
+            print("%-18s %s" % (key, "%.1f" % value if isinstance(value, float) else value))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# bench_filters.py
+# Copyright (C) ContinuumBridge Limited, 2015 - All Rights Reserved
+#
+""" Times the shared deadband filter table on its own, without the rest of the app.
+
+    A third of the series have three axes, as acceleration does, and the rest one value.
+    Each series is a random walk and samples are tested round robin, one per series at
+    a time. Reports samples/sec and the percentage of samples that passed.
+
+    Examples:
+        python bench/bench_filters.py
+        python bench/bench_filters.py --series 10000 --rounds 50 --step 0.05
+"""
+
+import os
+import sys
+import random
+import tempfile
+import argparse
+import shutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import bench_data_sender as bench
+
+def run(args):
+    configDir = tempfile.mkdtemp(prefix="data_sender_bench")
+    try:
+        clock = bench.Clock(args.start)
+        ds, reactor = bench.install(configDir + os.sep, clock)
+        filters = ds.DeadbandFilters()
+        rnd = random.Random(args.seed)
+        series = []
+        for i in range(args.series):
+            if i % 3 == 0:
+                f = filters.add(3, "accel_min_change", strict=True)
+                series.append((f, [rnd.gauss(0, 1) for axis in range(3)]))
+            else:
+                f = filters.add(1, "temp_min_change")
+                series.append((f, [rnd.gauss(20, 1)]))
+        # Work out the samples first, so only the filters are timed
+        samples = []
+        for r in range(args.rounds):
+            t = args.start + r
+            for f, walk in series:
+                for axis in range(len(walk)):
+                    walk[axis] += rnd.gauss(0, args.step)
+                samples.append((f, tuple(walk), t))
+        timer = getattr(bench._time, "perf_counter", bench._time.time)
+        test = filters.test
+        began = timer()
+        passed = 0
+        for f, values, t in samples:
+            if test(f, values, t):
+                passed += 1
+        elapsed = timer() - began
+        return {"series": args.series,
+                "samples": len(samples),
+                "samples_per_sec": len(samples)/elapsed if elapsed else 0.0,
+                "passed_percent": 100.0*passed/len(samples) if samples else 0.0
+               }
+    finally:
+        shutil.rmtree(configDir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark data_sender.py's deadband filter table")
+    parser.add_argument("--series", type=int, default=10000, help="number of series")
+    parser.add_argument("--rounds", type=int, default=20, help="samples per series")
+    parser.add_argument("--step", type=float, default=0.05,
+                        help="standard deviation of each step of the random walks")
+    parser.add_argument("--start", type=float, default=1.5e9, help="simulated start time")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    report = run(args)
+    for key in sorted(report):
+        value = report[key]
+        print("%-16s %s" % (key, "%.1f" % value if isinstance(value, float) else value))
+
+if __name__ == '__main__':
+    main()
@@ -7,32 +7,84 @@
 # Default values:
 config = {
     "data_send_delay": 1,
+    "data_send_delay_min": 0.5,
+    "data_send_delay_max": 10,
+    "data_send_delay_adaptive": False,
+    "max_batch_points": 2000,
+    "max_batch_bytes": 65536,
+    "wire_encoding": "json",
+    "compress_codec": "none",
+    "compress_threshold": 2048,
+    "spool": True,
+    "spool_max_bytes": 1024*1024*8,
+    "spool_segment_bytes": 1024*256,
+    "spool_client_backlog": 10,
     "max_interval": 60*60*12,
+    "keepalive": True,
+    "keepalive_tick": 60,
+    "metrics": False,
+    "stats_interval": 300,
+    "reconfigure_rate": 5,
+    "presync_buffer": 5000,
+    "sinks": {},
+    "high_water_points": 0,
+    "shed_ratio": 4,
+    "shed_keep": ["binary_sensor", "connected", "battery"],
+    "characteristics": {},
+    "workers": 0,
+    "shard_ring_bytes": 1024*1024*4,
+    "history_points": 0,
+    "history_mmap": False,
+    "history_chunk_points": 500,
+    "adaptive_polling": False,
+    "polling_review_interval": 900,
+    "polling_min_factor": 0.25,
+    "polling_max_factor": 8,
+    "polling_quiet_rate": 0.1,
+    "polling_busy_rate": 0.5,
+    "filter_snapshot": True,
+    "filter_snapshot_interval": 300,
+    "filter_snapshot_max_age": 3600,
     "temperature": True,
     "temp_min_change": 0.1,
     "temperature_polling_interval": 300,
+    "temperature_mode": "deadband",
+    "temperature_max_error": 0.1,
     "irtemperature": False,
     "irtemp_min_change": 0.5,
     "humidity": True,
     "humidity_min_change": 0.2,
     "humidity_polling_interval": 300,
+    "humidity_mode": "deadband",
+    "humidity_max_error": 0.2,
     "buttons": False,
     "accel": False,
     "accel_min_change": 0.02,
     "accel_polling_interval": 3.0,
+    "accel_mode": "deadband",
+    "accel_aggregate_window": 60,
     "gyro": False,
     "gyro_min_change": 0.5,
     "gyro_polling_interval": 3.0,
+    "gyro_mode": "deadband",
+    "gyro_aggregate_window": 60,
     "magnet": False,
     "magnet_min_change": 1.5,
     "magnet_polling_interval": 3.0,
+    "magnet_mode": "deadband",
+    "magnet_aggregate_window": 60,
+    "aggregate_rms": False,
     "binary": True,
     "luminance": True,
     "luminance_min_change": 10.0,
     "luminance_polling_interval": 300,
+    "luminance_mode": "deadband",
+    "luminance_max_error": 10.0,
     "power": True,
     "power_min_change": 1.0,
     "power_polling_interval": 300,
+    "power_mode": "deadband",
+    "power_max_error": 1.0,
     "battery": True,
     "battery_min_change": 1.0,
     "battery_polling_interval": 300,
@@ -47,7 +99,27 @@ from cbcommslib import CbApp, CbClient
 from cbconfig import *
 import requests
 import json
+import struct
+import base64
+import zlib
+import logging
+import mmap
+import hashlib
+import marshal
+import heapq
+import numbers
+import threading
+import traceback
+import multiprocessing
+from array import array
+from collections import deque, OrderedDict
+from operator import itemgetter
 from twisted.internet import reactor
+from twisted.internet import threads
+try:
+    import lzma
+except ImportError:
+    lzma = None
 #from cbutils import timeCorrect
 # Can be removed after all bridges are at a version that supports timeCorrect()
 def timeCorrect():
@@ -56,342 +128,1683 @@ def timeCorrect():
     else:
         return True
 
+def monotonic():
+    """ Seconds from an arbitrary point, unaffected by the wall clock being set """
+    try:
+        return time.monotonic()
+    except AttributeError:
+        # Python 2. On Linux this is the time since boot, from times(2).
+        return os.times()[4]
+
+try:
+    intern = sys.intern
+except AttributeError:
+    pass # Python 2 builtin
+
+DEFAULT_CONFIG = config.copy()
+
+# Config that is divided by, or is an interval or size, so must be more than 0. As are
+# keys ending in one of POSITIVE_SUFFIXES.
+POSITIVE_CONFIG = set(["data_send_delay", "data_send_delay_min", "data_send_delay_max", "max_batch_points",
+                       "max_batch_bytes", "spool_max_bytes", "spool_segment_bytes", "spool_client_backlog",
+                       "max_interval", "keepalive_tick", "stats_interval", "reconfigure_rate", "shed_ratio",
+                       "shard_ring_bytes", "history_chunk_points", "polling_review_interval",
+                       "polling_min_factor", "polling_max_factor", "filter_snapshot_interval",
+                       "filter_snapshot_max_age"])
+POSITIVE_SUFFIXES = ("_polling_interval", "_aggregate_window")
+
 CONFIG_FILE                       = CB_CONFIG_DIR + "data_sender.config"
+SPOOL_PREFIX                      = "data_sender.spool."
+HISTORY_PREFIX                    = "data_sender.history."
+STATS_FILE                        = CB_CONFIG_DIR + "data_sender.stats"
+FILTERS_FILE                      = CB_CONFIG_DIR + "data_sender.filters"
 CID                               = "CID164"  # Client ID
+BINARY_ENCODING                   = "b1"      # Name of the binary encoding offered to the client
+SERIES_BYTES                      = 24        # Approximate JSON overhead of a series entry
+POINT_BYTES                       = 24        # Approximate JSON size of one [timestamp, value] point
 
-class DataManager:
-    """ Managers data storage for all sensors """
+LOG_LEVELS = {"debug": logging.DEBUG,
+              "info": logging.INFO,
+              "warning": logging.WARNING,
+              "error": logging.ERROR
+             }
+
+class Json:
+    """ Defers json.dumps until a log message is actually formatted """
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=4)
+
+class Joined:
+    """ Defers joining the sorted items of a collection until a log message is formatted """
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return ", ".join(sorted(self.items))
+
+class Log:
+    """ Front end to cbLog that only formats a message if its level is enabled.
+        Arguments are %-formatted into fmt, so wrap objects in Json() rather than
+        calling json.dumps at the call site. Optional keyword arguments, keyed on fmt:
+            every: only log one message in every n
+            interval: log at most once every interval seconds
+    """
+    def __init__(self, cbLog):
+        self.cbLog = cbLog
+        self.logger = logging.getLogger()
+        self.counts = {}
+        self.lastTimes = {}
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(LOG_LEVELS[level])
+
+    def __call__(self, level, fmt, *args, **kwargs):
+        if not self.logger.isEnabledFor(LOG_LEVELS[level]):
+            return
+        if kwargs:
+            every = kwargs.get("every")
+            if every:
+                count = self.counts.get(fmt, 0)
+                self.counts[fmt] = count + 1
+                if count % every:
+                    return
+            interval = kwargs.get("interval")
+            if interval:
+                now = time.time()
+                if now - self.lastTimes.get(fmt, 0) < interval:
+                    return
+                self.lastTimes[fmt] = now
+        if args:
+            fmt = fmt % args
+        self.cbLog(level, fmt)
+
+    def debug(self, fmt, *args, **kwargs):
+        self("debug", fmt, *args, **kwargs)
+
+class Histogram:
+    """ Counts of values in power of two buckets. Values are multiplied by scale first. """
+    __slots__ = ("scale", "buckets", "count", "total", "max")
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.buckets = [0]*32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        n = int(value*self.scale)
+        self.buckets[min(n.bit_length(), 31) if n > 0 else 0] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p'th percentile """
+        target = self.count*p/100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(float(2**i)/self.scale, self.max)
+        return 0.0
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total/self.count if self.count else 0.0,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                "max": self.max
+               }
+
+class Metrics:
+    """ Counts of samples received, suppressed and emitted for each characteristic and device,
+        and histograms of flush sizes, flush latency and time spent in onAdaptorData.
+    """
     def __init__(self):
+        self.started = time.time()
+        self.counts = {}                        # (characteristic, device) -> [received, suppressed, emitted]
+        self.flushPoints = Histogram()
+        self.flushLatency = Histogram(1000)     # ms
+        self.dataTime = Histogram(1000000)      # us
+
+    def sample(self, characteristic, device, emitted, elapsed):
+        try:
+            counts = self.counts[(characteristic, device)]
+        except KeyError:
+            counts = self.counts[(characteristic, device)] = [0, 0, 0]
+        counts[0] += 1
+        if emitted:
+            counts[2] += emitted
+        else:
+            counts[1] += 1
+        self.dataTime.record(elapsed)
+
+    def flush(self, points, latency):
+        self.flushPoints.record(points)
+        self.flushLatency.record(latency)
+
+    def report(self):
+        characteristics = {}
+        for (characteristic, device), (received, suppressed, emitted) in self.counts.items():
+            characteristics.setdefault(characteristic, {})[device] = {"received": received,
+                                                                      "suppressed": suppressed,
+                                                                      "emitted": emitted}
+        return {"since": self.started,
+                "characteristics": characteristics,
+                "flush_points": self.flushPoints.summary(),
+                "flush_latency": self.flushLatency.summary(),
+                "adaptor_data": self.dataTime.summary()
+               }
+
+class Series:
+    """ Points for one series, held as time and value columns until sent """
+    __slots__ = ("name", "times", "values")
+
+    def __init__(self, name, value):
+        self.name = name
+        self.times = array("d")
+        if isinstance(value, float):
+            self.values = array("d")
+        else:
+            self.values = []
+
+    def append(self, t, value):
+        try:
+            self.values.append(value)
+        except TypeError:
+            # Not a number after all, so fall back to a plain list
+            self.values = list(self.values)
+            self.values.append(value)
+        self.times.append(t)
+
+    def points(self):
+        return [[int(t), v] for t, v in zip(self.times, self.values)]
+
+SUFFIXES = ("/accel/x", "/accel/y", "/accel/z", "/temperature", "/ir_temperature", "/humidity",
+            "/gyro/x", "/gyro/y", "/gyro/z", "/magnet/x", "/magnet/y", "/magnet/z",
+            "/binary", "/luminance", "/power", "/battery", "/connected")
+
+class SeriesNames(dict):
+    """ Interned series names for one device, keyed by suffix """
+    def __init__(self, prefix):
+        dict.__init__(self)
+        self.prefix = prefix
+        for suffix in SUFFIXES:
+            self[suffix]
+
+    def __missing__(self, suffix):
+        name = self.prefix + suffix
+        try:
+            name = intern(name)
+        except TypeError:
+            pass # Python 2 can only intern byte strings
+        self[suffix] = name
+        return name
+
+class NameTable(dict):
+    """ SeriesNames for each device, created when a device is first seen """
+    def __init__(self, baseAddress):
+        dict.__init__(self)
+        self.baseAddress = baseAddress
+
+    def __missing__(self, deviceID):
+        names = self[deviceID] = SeriesNames(self.baseAddress + deviceID)
+        return names
+
+def jsonType(v):
+    if isinstance(v, bool):
+        return "boolean"
+    if isinstance(v, numbers.Number):
+        return "number"
+    if isinstance(v, (dict, list)) or v is None:
+        return type(v)
+    return "string"
+
+def schemaError(schema, settings):
+    """ Why a schema in config["characteristics"] can't be used with settings (ie: config),
+        or None if it can
+    """
+    if not isinstance(schema, dict):
+        return "not an object"
+    for key in ("enable", "series"):
+        if jsonType(schema.get(key)) != "string":
+            return "%s should be a string" % key
+    if "axes" in schema:
+        axes = schema["axes"]
+        if (not isinstance(axes, list) or not axes or
+                not all(jsonType(a) == "string" or (isinstance(a, list) and len(a) == 2 and
+                                                    all(jsonType(k) == "string" for k in a)) for a in axes)):
+            return "axes should be a list of keys or [key, series name] pairs"
+    if "transform" in schema and schema["transform"] not in TRANSFORMS:
+        return "unknown transform %s" % schema["transform"]
+    for key in ("strict", "filter", "new_time"):
+        if key in schema and jsonType(schema[key]) != "boolean":
+            return "%s should be true or false" % key
+    for key in ("min_change", "max_interval", "polling"):
+        if key in schema and jsonType(settings.get(schema[key])) != "number":
+            return "%s names %s, which is not a number in config" % (key, schema[key])
+    if settings.get(schema["enable"] + "_mode") == "swinging_door" and \
+            jsonType(settings.get(schema["enable"] + "_max_error")) != "number":
+        return "%s_max_error is not a number in config" % schema["enable"]
+    return None
+
+def validConfig(newConfig, log):
+    """ The entries of newConfig that have the same JSON type as the defaults. Others are logged and left out.
+        Characteristics that can't be used with newConfig merged into config are left out too.
+    """
+    if not isinstance(newConfig, dict):
+        log("warning", "Ignoring config that is not an object: %s", Json(newConfig))
+        return {}
+    valid = {}
+    for key, value in newConfig.items():
+        if key in DEFAULT_CONFIG and jsonType(value) != jsonType(DEFAULT_CONFIG[key]):
+            log("warning", "Ignoring config %s: %s, which should be like %s", key, Json(value), Json(DEFAULT_CONFIG[key]))
+        elif (jsonType(value) == "number" and not value > 0 and
+                (key in POSITIVE_CONFIG or key.endswith(POSITIVE_SUFFIXES))):
+            log("warning", "Ignoring config %s: %s, which should be more than 0", key, Json(value))
+        else:
+            valid[key] = value
+    settings = dict(config)
+    settings.update(valid)
+    schemas = {}
+    for name, schema in settings["characteristics"].items():
+        error = schemaError(schema, settings)
+        if error is None:
+            schemas[name] = schema
+        else:
+            log("warning", "Ignoring characteristic %s: %s", name, error)
+    if len(schemas) != len(settings["characteristics"]):
+        valid["characteristics"] = schemas
+    return valid
+
+def readJson(fileName, log):
+    """ Reads a file written by Persistence, falling back to the backup of the one before if
+        it is missing or cannot be parsed. Returns None if neither can be read.
+    """
+    for name in (fileName, fileName + ".bak"):
+        try:
+            with open(name, 'r') as f:
+                return json.load(f)
+        except IOError as ex:
+            if os.path.isfile(name):
+                log("warning", "Could not read %s: %s", name, ex)
+        except ValueError as ex:
+            log("warning", "%s is corrupt: %s", name, ex)
+    return None
+
+class Persistence:
+    """ Writes files from a thread, so that slow storage doesn't hold up the reactor. Each write
+        replaces the file atomically: the data goes to a temporary file, which is synced and
+        renamed over the old one. Writes to a file that is already being written wait, and
+        only the latest of them is written.
+    """
+    def __init__(self):
+        self.log = None
+        self.lock = threading.Lock()    # Held while writing
+        self.pending = {}       # File name -> (sequence number, data, backup), or data None to remove it
+        self.writing = set()
+        self.sequence = 0
+        self.written = {}       # File name -> sequence number last written
+
+    def write(self, fileName, data, backup=False):
+        """ Queues data (bytes) to be written. With backup, the file it replaces is kept as fileName.bak. """
+        self.sequence += 1
+        self.pending[fileName] = (self.sequence, data, backup)
+        if fileName not in self.writing:
+            self.start(fileName)
+
+    def remove(self, fileName):
+        self.write(fileName, None)
+
+    def start(self, fileName):
+        self.writing.add(fileName)
+        d = threads.deferToThread(self.writeFile, fileName, *self.pending.pop(fileName))
+        d.addErrback(self.failed, fileName)
+        d.addCallback(self.done, fileName)
+
+    def failed(self, failure, fileName):
+        self.log("warning", "Could not write %s: %s", fileName, failure.getErrorMessage())
+
+    def done(self, result, fileName):
+        self.writing.discard(fileName)
+        if fileName in self.pending:
+            self.start(fileName)
+
+    def writeFile(self, fileName, sequence, data, backup):
+        with self.lock:
+            if sequence <= self.written.get(fileName, 0):
+                return # Already overtaken by flush
+            self.written[fileName] = sequence
+            if data is None:
+                if os.path.isfile(fileName):
+                    os.remove(fileName)
+                return
+            temporary = fileName + ".tmp"
+            with open(temporary, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if backup and os.path.isfile(fileName):
+                os.rename(fileName, fileName + ".bak")
+            os.rename(temporary, fileName)
+
+    def flush(self):
+        """ Writes anything waiting from this thread, for when the reactor is stopping """
+        pending = self.pending
+        self.pending = {}
+        for fileName, (sequence, data, backup) in pending.items():
+            try:
+                self.writeFile(fileName, sequence, data, backup)
+            except Exception as ex:
+                self.log("warning", "Could not write %s: %s", fileName, ex)
+
+persistence = Persistence()
+
+class Spool:
+    """ Append-only queue of data messages on disk, held in numbered segment files.
+        Segments are deleted once everything in them has been replayed and the oldest
+        segments are evicted if the spool grows beyond maxBytes.
+    """
+    def __init__(self, directory, prefix, maxBytes, segmentBytes):
+        self.directory = directory
+        self.prefix = prefix
+        self.maxBytes = maxBytes
+        self.segmentBytes = segmentBytes
+        self.sizes = {}
+        for f in os.listdir(directory):
+            if f.startswith(prefix) and f[len(prefix):].isdigit():
+                self.sizes[int(f[len(prefix):])] = os.path.getsize(os.path.join(directory, f))
+        self.segments = sorted(self.sizes)
+        self.next = self.segments[-1] + 1 if self.segments else 0
+        self.offset = 0     # Read position in the oldest segment
+        self.evicted = 0
+        try:
+            with open(self.fileName("pos"), 'r') as f:
+                segment, offset = f.read().split()
+            if self.segments and int(segment) == self.segments[0]:
+                self.offset = int(offset)
+        except Exception:
+            pass
+
+    def fileName(self, segment):
+        return os.path.join(self.directory, self.prefix + str(segment))
+
+    def empty(self):
+        return not self.segments or (len(self.segments) == 1 and self.offset >= self.sizes[self.segments[0]])
+
+    def append(self, msg):
+        line = json.dumps(msg) + "\n"
+        if not self.segments or self.sizes[self.segments[-1]] >= self.segmentBytes:
+            self.segments.append(self.next)
+            self.sizes[self.next] = 0
+            self.next += 1
+        segment = self.segments[-1]
+        with open(self.fileName(segment), 'a') as f:
+            f.write(line)
+        self.sizes[segment] += len(line)
+        while sum(self.sizes.values()) > self.maxBytes and len(self.segments) > 1:
+            self.remove(self.segments[0])
+            self.evicted += 1
+
+    def pop(self):
+        """ Returns the oldest message in the spool, or None if it is empty """
+        while self.segments:
+            segment = self.segments[0]
+            if self.offset < self.sizes[segment]:
+                with open(self.fileName(segment), 'r') as f:
+                    f.seek(self.offset)
+                    line = f.readline()
+                self.offset += len(line)
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    continue # Torn write
+            self.remove(segment)
+        return None
+
+    def remove(self, segment):
+        os.remove(self.fileName(segment))
+        del self.sizes[segment]
+        if segment == self.segments[0]:
+            self.offset = 0
+        self.segments.remove(segment)
+
+    def savePosition(self):
+        if self.segments:
+            persistence.write(self.fileName("pos"), (str(self.segments[0]) + " " + str(self.offset)).encode("ascii"))
+        else:
+            persistence.remove(self.fileName("pos"))
+
+class History:
+    """ The last capacity points sent for each series, in a ring buffer per series. Buffers
+        are held in memory or, if directory is given, in files mapped into memory, which
+        outlast restarts. Each buffer starts with the number of points ever written to it
+        and its capacity, followed by (time, value) pairs as doubles. Each open map holds a
+        file descriptor, so only the maxOpen most recently used are kept open.
+    """
+    HEADER = struct.Struct("<QQ")
+    POINT = struct.Struct("<dd")
+
+    def __init__(self, capacity, directory=None, prefix=HISTORY_PREFIX, maxOpen=64):
+        self.capacity = capacity
+        self.directory = directory
+        self.prefix = prefix
+        self.maxOpen = maxOpen
+        self.buffers = OrderedDict()    # Series name -> bytearray or mmap, least recently used first
+
+    def buffer(self, name, create):
+        try:
+            buf = self.buffers[name]
+        except KeyError:
+            pass
+        else:
+            if self.directory is not None:
+                del self.buffers[name]
+                self.buffers[name] = buf
+            return buf
+        size = self.HEADER.size + self.capacity*self.POINT.size
+        if self.directory is None:
+            if not create:
+                return None
+            buf = bytearray(size)
+            self.HEADER.pack_into(buf, 0, 0, self.capacity)
+        else:
+            fileName = os.path.join(self.directory, self.prefix + hashlib.md5(name.encode("utf-8")).hexdigest())
+            if not os.path.isfile(fileName) or os.path.getsize(fileName) != size:
+                if not create and not os.path.isfile(fileName):
+                    return None
+                # New, or kept with a different capacity
+                with open(fileName, 'wb') as f:
+                    f.write(self.HEADER.pack(0, self.capacity))
+                    f.truncate(size)
+            if len(self.buffers) >= self.maxOpen:
+                self.buffers.popitem(last=False)[1].close()
+            with open(fileName, 'r+b') as f:
+                buf = mmap.mmap(f.fileno(), size)
+        self.buffers[name] = buf
+        return buf
+
+    def extend(self, name, times, values):
+        buf = self.buffer(name, True)
+        written, capacity = self.HEADER.unpack_from(buf, 0)
+        for t, v in zip(times, values):
+            try:
+                self.POINT.pack_into(buf, self.HEADER.size + (written % capacity)*self.POINT.size, t, v)
+            except struct.error:
+                continue # Not a number
+            written += 1
+        self.HEADER.pack_into(buf, 0, written, capacity)
+
+    def find(self, name, start):
+        """ Position of the first point of series name at or after time start (in ms) """
+        buf = self.buffer(name, False)
+        if buf is None:
+            return 0
+        written, capacity = self.HEADER.unpack_from(buf, 0)
+        low = max(written - capacity, 0)
+        high = written
+        while low < high:
+            middle = (low + high)//2
+            t = struct.unpack_from("<d", buf, self.HEADER.size + (middle % capacity)*self.POINT.size)[0]
+            if t < start:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read(self, name, position, count, end):
+        """ Up to count points from position on, as far as time end. Returns the points and
+            the position to carry on from, or None if there are no more.
+        """
+        buf = self.buffer(name, False)
+        if buf is None:
+            return [], None
+        written, capacity = self.HEADER.unpack_from(buf, 0)
+        # Points may have been overwritten since position was found
+        position = max(position, written - capacity)
+        points = []
+        while position < written and len(points) < count:
+            t, v = self.POINT.unpack_from(buf, self.HEADER.size + (position % capacity)*self.POINT.size)
+            if t > end:
+                return points, None
+            points.append([int(t), v])
+            position += 1
+        return points, position if position < written else None
+
+def putVarint(buf, n):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+# Compression codecs for data messages, by the name put in their "c" field
+CODECS = {"zlib": zlib.compress}
+if lzma is not None:
+    CODECS["lzma"] = lzma.compress
+
+class BinaryEncoder:
+    """ Packs the series in a data message into bytes. Each series name is sent once per
+        connection and referred to by a number after that. Layout, using unsigned LEB128
+        varints and zigzag varints for signed values:
+            version (1 byte)
+            base time stamp in ms (varint)
+            number of series (varint)
+            for each series:
+                (series number << 1) | 1 if the name follows, else 0 (varint)
+                name length and UTF-8 name (varint, bytes), if new
+                number of points (varint)
+                time stamp deltas in ms (zigzag varints), the first from the base
+                values (little-endian float32)
+    """
+    VERSION = 1
+
+    def __init__(self):
+        self.ids = {}
+
+    def encode(self, msg):
+        """ Returns the series in msg as bytes, or None if there is a value that isn't a number """
+        d = msg["d"]
+        times = [p[0] for s in d for p in s["points"]]
+        base = min(times) if times else 0
+        buf = bytearray([self.VERSION])
+        putVarint(buf, base)
+        putVarint(buf, len(d))
+        ids = {}
+        for s in d:
+            name = s["name"]
+            points = s["points"]
+            try:
+                values = struct.pack("<%df" % len(points), *[p[1] for p in points])
+            except struct.error:
+                return None
+            if name in self.ids:
+                putVarint(buf, self.ids[name] << 1)
+            elif name in ids:
+                putVarint(buf, ids[name] << 1)
+            else:
+                ids[name] = len(self.ids) + len(ids)
+                putVarint(buf, ids[name] << 1 | 1)
+                encoded = name.encode("utf-8")
+                putVarint(buf, len(encoded))
+                buf.extend(encoded)
+            putVarint(buf, len(points))
+            previous = base
+            for p in points:
+                delta = p[0] - previous
+                putVarint(buf, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+                previous = p[0]
+            buf.extend(values)
+        # Only remember new names once the whole message has been encoded
+        self.ids.update(ids)
+        return bytes(buf)
+
+class DataManager:
+    """ Batches data for one client. The primary DataManager takes its settings from config.
+        Others (sinks) are named in config["sinks"] and have settings of their own, falling
+        back to config, and may be limited to some characteristics and min_change values.
+    """
+    def __init__(self, name=None, settings=None, log=None):
+        self.name = name
+        self.settings = settings or {}
+        self.log = log
+        self.s = []             # Series in order of first sample this window
+        self.series = {}        # name -> Series
+        self.points = 0
+        self.bytes = 0
+        self.stored = 0         # Points stored since start
+        self.batchStart = 0
+        self.metrics = None
+        self.sendTimer = None
+        self.client = None
+        self.spool = None
+        self.linkReady = False
+        self.encoder = None
+        self.compressionStats = {"batches": 0, "raw_bytes": 0, "compressed_bytes": 0, "seconds": 0.0}
+        self.history = None
+        self.flight = deque()   # Points in each data message the client has yet to acknowledge
+        self.inFlight = 0
+        self.shedding = False
+        self.shedSeen = {}      # Series name -> values seen while shedding
+        self.shed = {}          # Characteristic -> values shed
+        self.configure()
+
+    def setting(self, key):
+        return self.settings.get(key, config[key])
+
+    def configure(self):
+        """ Takes flush limits from config. Called whenever config changes. """
+        setting = self.setting
+        self.cid = self.settings.get("cid", CID)
+        self.maxPoints = setting("max_batch_points")
+        self.maxBytes = setting("max_batch_bytes")
+        self.minDelay = setting("data_send_delay_min")
+        self.maxDelay = setting("data_send_delay_max")
+        self.adaptive = setting("data_send_delay_adaptive")
+        self.delay = min(max(setting("data_send_delay"), self.minDelay), self.maxDelay)
+        self.maxBacklog = setting("spool_client_backlog")
+        self.codec = setting("compress_codec")
+        self.compressThreshold = setting("compress_threshold")
+        if self.codec != "none" and self.codec not in CODECS:
+            self.log("warning", "Compression codec %s is not available, sending uncompressed", self.codec)
+        if not setting("spool"):
+            self.spool = None
+        elif self.spool is None:
+            prefix = SPOOL_PREFIX if self.name is None else SPOOL_PREFIX + self.name + "."
+            self.spool = Spool(CB_CONFIG_DIR, prefix, setting("spool_max_bytes"), setting("spool_segment_bytes"))
+        else:
+            self.spool.maxBytes = setting("spool_max_bytes")
+            self.spool.segmentBytes = setting("spool_segment_bytes")
+        if not setting("history_points") or self.name is not None:
+            # Only kept for the primary client
+            self.history = None
+        elif self.history is None or self.history.capacity != setting("history_points"):
+            self.history = History(setting("history_points"), CB_CONFIG_DIR if setting("history_mmap") else None)
+        characteristics = self.settings.get("characteristics")
+        self.characteristics = None if characteristics is None else set(characteristics)
+        self.minChange = self.settings.get("min_change", {})
+        self.selected = {}      # Series name -> min_change, or None if not wanted
+        self.lastValue = {}
+        self.highWater = setting("high_water_points")
+        self.shedRatio = setting("shed_ratio")
+        self.keep = set(setting("shed_keep"))
+
+    def wants(self, name, value, characteristic):
+        """ Whether a sink limited to some characteristics or min_change values takes this value """
+        try:
+            minChange = self.selected[name]
+        except KeyError:
+            if self.characteristics is None or characteristic in self.characteristics:
+                minChange = self.minChange.get(characteristic, 0.0)
+            else:
+                minChange = None
+            self.selected[name] = minChange
+        if minChange is None:
+            return False
+        if minChange:
+            last = self.lastValue.get(name)
+            if last is not None and abs(value - last) < minChange:
+                return False
+            self.lastValue[name] = value
+        return True
+
+    def onClientMessage(self, message):
+        """ For sinks. Only the primary client can change config. """
+        if "encoding" in message:
+            self.setEncoding(message["encoding"])
+
+    def clientBacklog(self):
+        # CbClient holds on to messages until the client has acknowledged them
+        return len(getattr(self.client, "messages", ()))
+
+    def linkClear(self):
+        return self.linkReady and self.clientBacklog() < self.maxBacklog
+
+    def onLinkReady(self):
+        self.linkReady = True
+        # A new connection, so the client must accept the encoding again
+        self.encoder = None
+        self.replay()
+
+    def setEncoding(self, encoding):
+        if encoding == BINARY_ENCODING and self.setting("wire_encoding") == "binary":
+            self.encoder = BinaryEncoder()
+        else:
+            self.encoder = None
+        self.log("info", "Data encoding: %s", encoding if self.encoder else "json")
+
+    def transmit(self, msg):
+        """ Encodes and compresses a data message as negotiated and configured, then sends it.
+            Binary and compressed payloads are base64 encoded in "d", with "e" naming the
+            encoding and "c" the compression codec.
+        """
+        payload = None
+        out = {"m": "data"}
+        if self.encoder is not None:
+            payload = self.encoder.encode(msg)
+            if payload is not None:
+                out["e"] = BINARY_ENCODING
+        compress = CODECS.get(self.codec)
+        if compress is not None:
+            if payload is None:
+                payload = json.dumps(msg["d"], separators=(",", ":")).encode("utf-8")
+            if len(payload) >= self.compressThreshold:
+                start = time.time()
+                compressed = compress(payload)
+                elapsed = time.time() - start
+                stats = self.compressionStats
+                stats["batches"] += 1
+                stats["raw_bytes"] += len(payload)
+                stats["compressed_bytes"] += len(compressed)
+                stats["seconds"] += elapsed
+                self.log.debug("transmit. %s compressed %s bytes to %s in %.1f ms",
+                               self.codec, len(payload), len(compressed), elapsed*1000)
+                if len(compressed) < len(payload):
+                    out["c"] = self.codec
+                    payload = compressed
+        points = sum(len(s["points"]) for s in msg["d"]) if self.highWater else 0
+        if "e" in out or "c" in out:
+            out["d"] = base64.b64encode(payload).decode("ascii")
+            msg = out
+        self.client.send(msg)
+        if points:
+            self.flight.append(points)
+            self.inFlight += points
+            self.reconcile()
+
+    def reconcile(self):
+        """ Drops acknowledged messages from the points in flight. Called after sending and
+            after messages from the concentrator, which may include acknowledgements.
+        """
+        backlog = self.clientBacklog()
+        while len(self.flight) > backlog:
+            self.inFlight -= self.flight.popleft()
+        if self.shedding and self.points + self.inFlight < self.highWater:
+            self.shedding = False
+            self.log("info", "Stopped shedding data. Shed so far: %s", Json(self.shed))
+
+    def replay(self):
+        """ Hands spooled batches to the client, oldest first, while the link can take them """
+        if self.flight:
+            self.reconcile()
+        if self.spool is None or self.client is None:
+            return
+        sent = 0
+        while self.linkClear():
+            msg = self.spool.pop()
+            if msg is None:
+                break
+            self.transmit(msg)
+            sent += 1
+        if sent:
+            self.spool.savePosition()
+            self.log.debug("replay. Sent %s spooled batches", sent)
+
+    def adaptDelay(self, early):
+        """ Shortens the delay under load and lengthens it when traffic is sparse """
+        if early:
+            self.delay = max(self.delay/2.0, self.minDelay)
+        elif self.points < self.maxPoints/10:
+            self.delay = min(self.delay*2.0, self.maxDelay)
+
+    def sendValues(self):
+        early = self.sendTimer is not None and self.sendTimer.active()
+        if early:
+            self.sendTimer.cancel()
+        self.sendTimer = None
+        msg = {"m": "data",
+               "d": [{"name": s.name, "points": s.points()} for s in self.s]
+               }
+        self.log.debug("sendValues. Sending: %s", Json(msg))
+        try:
+            # Kept first, so that it can be backfilled if sending fails
+            if self.history is not None:
+                for s in self.s:
+                    self.history.extend(s.name, s.times, s.values)
+            if self.spool is None or (self.spool.empty() and self.linkClear()):
+                self.transmit(msg)
+                if self.metrics is not None:
+                    self.metrics.flush(self.points, time.time() - self.batchStart)
+            else:
+                # Keep batches in order behind anything already spooled
+                self.spool.append(msg)
+                self.replay()
+            if self.adaptive:
+                self.adaptDelay(early)
+        finally:
+            # Start a new batch whatever happens, rather than sending this one again and again
+            self.s = []
+            self.series = {}
+            self.points = 0
+            self.bytes = 0
+
+    def shedValue(self, name, characteristic):
+        """ Called once points in memory (this batch and those the client has yet to acknowledge)
+            reach the high water mark. Keeps characteristics in shed_keep, one in shed_ratio
+            values of others, and none of them past twice the mark. Returns True to drop the value.
+        """
+        if characteristic in self.keep:
+            return False
+        if self.points + self.inFlight < 2*self.highWater:
+            seen = self.shedSeen.get(name, 0) + 1
+            self.shedSeen[name] = seen
+            if seen % self.shedRatio == 0:
+                return False
+        self.shed[characteristic] = self.shed.get(characteristic, 0) + 1
+        if not self.shedding:
+            self.shedding = True
+            self.log("warning", "%s points waiting to be sent. Shedding data", self.points + self.inFlight)
+        return True
+
+    def storeValues(self, name, timeStamp, value, characteristic):
+        if self.highWater and self.points + self.inFlight >= self.highWater and self.shedValue(name, characteristic):
+            return
+        try:
+            series = self.series[name]
+        except KeyError:
+            series = self.series[name] = Series(name, value)
+            self.s.append(series)
+            self.bytes += len(name) + SERIES_BYTES
+        series.append(int(timeStamp*1000), value)
+        if not self.points:
+            self.batchStart = time.time()
+        self.points += 1
+        self.stored += 1
+        self.bytes += POINT_BYTES
+        if self.points >= self.maxPoints or self.bytes >= self.maxBytes:
+            self.sendValues()
+        elif self.sendTimer is None:
+            self.sendTimer = reactor.callLater(self.delay, self.sendValues)
+
+class Router:
+    """ What processors store data through. Each value is stored once in the primary
+        DataManager and in any sinks that want it.
+    """
+    def __init__(self, primary):
         self.idToName = None
         self.baseAddress = None
-        self.s = []
-        self.waiting = False
+        self.names = None
+        self.primary = primary
+        self.extra = []         # Sinks
+
+    def sinks(self):
+        return [self.primary] + self.extra
 
     def initAddress(self, bridge_id, idToName):
         self.idToName = idToName
         self.baseAddress = bridge_id + "/"
+        # Called whenever idToName changes, so start a fresh name table
+        self.names = NameTable(self.baseAddress)
+        for deviceID in idToName.values():
+            self.names[deviceID]
 
-    def sendValues(self):
-        msg = {"m": "data",
-               "d": self.s
-               }
-        self.cbLog("debug", "sendValues. Sending: " + str(json.dumps(msg, indent=4)))
-        self.client.send(msg)
-        self.s = []
-        self.waiting = False
-
-    def storeValues(self, values):
-        self.s.append(values)
-        if not self.waiting:
-            self.waiting = True
-            reactor.callLater(config["data_send_delay"], self.sendValues)
-
-    def storeAccel(self, deviceID, timeStamp, a):
-        values = {"name": self.baseAddress + deviceID + "/accel/x",
-                  "points": [[int(timeStamp*1000), a[0]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/accel/y",
-                  "points": [[int(timeStamp*1000), a[1]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/accel/z",
-                  "points": [[int(timeStamp*1000), a[2]]]
-                 }
-        self.storeValues(values)
-
-    def storeTemp(self, deviceID, timeStamp, temp):
-        values = {"name": self.baseAddress + deviceID + "/temperature",
-                  "points": [[int(timeStamp*1000), temp]]
-                 }
-        self.storeValues(values)
-
-    def storeIrTemp(self, deviceID, timeStamp, temp):
-        values = {"name": self.baseAddress + deviceID + "/ir_temperature",
-                  "points": [[int(timeStamp*1000), temp]]
-                 }
-        self.storeValues(values)
-
-    def storeHumidity(self, deviceID, timeStamp, h):
-        values = {"name": self.baseAddress + deviceID + "/humidity",
-                   "points": [[int(timeStamp*1000), h]]
-                 }
-        self.storeValues(values)
-
-    def storeButtons(self, deviceID, timeStamp, buttons):
-        values = [
-                  {"n":"left_button", "v":buttons["leftButton"], "t":timeStamp},
-                  {"n":"right_button", "v":buttons["rightButton"], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeGyro(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/gyro/x",
-                  "points": [[int(timeStamp*1000), v[0]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/gyro/y",
-                  "points": [[int(timeStamp*1000), v[1]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/gyro/z",
-                  "points": [[int(timeStamp*1000), v[2]]]
-                 }
-        self.storeValues(values)
-
-    def storeMagnet(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/magnet/x",
-                  "points": [[int(timeStamp*1000), v[0]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/magnet/y",
-                  "points": [[int(timeStamp*1000), v[1]]]
-                 }
-        self.storeValues(values)
-        values = {"name": self.baseAddress + deviceID + "/magnet/z",
-                  "points": [[int(timeStamp*1000), v[2]]]
-                 }
-        self.storeValues(values)
-
-    def storeBinary(self, deviceID, timeStamp, b):
-        values = {"name": self.baseAddress + deviceID + "/binary",
-                  "points": [[int(timeStamp*1000), b]]
-                 }
-        self.storeValues(values)
-
-    def storeLuminance(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/luminance",
-                  "points": [[int(timeStamp*1000), v]]
-                 }
-        self.storeValues(values)
-
-    def storePower(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/power",
-                  "points": [[int(timeStamp*1000), v]]
-                 }
-        self.storeValues(values)
-
-    def storeBattery(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/battery",
-                  "points": [[int(timeStamp*1000), v]]
-                 }
-        self.storeValues(values)
-
-    def storeConnected(self, deviceID, timeStamp, v):
-        values = {"name": self.baseAddress + deviceID + "/connected",
-                  "points": [[int(timeStamp*1000), v]]
-                 }
-        self.storeValues(values)
+    def storeValues(self, name, timeStamp, value, characteristic):
+        self.primary.storeValues(name, timeStamp, value, characteristic)
+        for sink in self.extra:
+            if sink.wants(name, value, characteristic):
+                sink.storeValues(name, timeStamp, value, characteristic)
 
     def storeActivity(self, location, timeStamp, action, v):
-        values = {"name": self.baseAddress + location + "/" + action,
-                  "points": [[int(timeStamp*1000), v]]
-                 }
-        self.storeValues(values)
-
-class Accelerometer:
-    def __init__(self, id):
-        self.previous = [0.0, 0.0, 0.0]
+        self.storeValues(self.names[location]["/" + action], timeStamp, v, action)
+
+class DeadbandFilters:
+    """ Last sent values and thresholds for every filtered series, held in flat arrays.
+        A filter covers width consecutive slots, one per axis. A sample passes if any
+        axis has changed by more than the threshold (or by at least the threshold
+        unless strict) since the last sample that passed, or if maxInterval is set
+        and more than maxInterval seconds have gone by. heard is when the last sample
+        was tested, whether it passed or not.
+    """
+    def __init__(self):
+        self.previous = array("d")      # Per slot
+        self.start = array("i")         # Per filter from here on
+        self.threshold = array("d")
+        self.strict = array("b")
+        self.maxInterval = array("d")
+        self.lastTime = array("d")
+        self.heard = array("d")
+        self.sent = array("b")
+        self.keys = []                  # (threshold key, max interval key)
+        self.free = {}                  # width -> removed filters that can be reused
+
+    def add(self, width, thresholdKey, strict=False, maxIntervalKey=None, lastTime=0.0):
+        """ Returns the index of a new filter """
+        if self.free.get(width):
+            f = self.free[width].pop()
+            start = self.start[f]
+            self.previous[start:start + width] = array("d", [0.0]*width)
+            self.threshold[f] = config[thresholdKey] if thresholdKey else 0.0
+            self.strict[f] = strict
+            self.maxInterval[f] = config[maxIntervalKey] if maxIntervalKey else 0.0
+            self.lastTime[f] = lastTime
+            self.heard[f] = 0.0
+            self.sent[f] = False
+            self.keys[f] = (thresholdKey, maxIntervalKey)
+            return f
+        f = len(self.start)
+        self.start.append(len(self.previous))
+        self.previous.extend([0.0]*width)
+        self.threshold.append(config[thresholdKey] if thresholdKey else 0.0)
+        self.strict.append(strict)
+        self.maxInterval.append(config[maxIntervalKey] if maxIntervalKey else 0.0)
+        self.lastTime.append(lastTime)
+        self.heard.append(0.0)
+        self.sent.append(False)
+        self.keys.append((thresholdKey, maxIntervalKey))
+        return f
+
+    def state(self, f):
+        """ The last values sent through filter f, whether any have been, and when """
+        return (self.values(f), self.sent[f], self.lastTime[f])
+
+    def restore(self, f, state):
+        """ Carries on from a state returned by state(). Returns False, leaving the filter
+            as it is, if the state is for a different number of values.
+        """
+        values, sent, lastTime = state
+        start = self.start[f]
+        if len(values) != len(self.values(f)):
+            return False
+        self.previous[start:start + len(values)] = array("d", values)
+        self.sent[f] = sent
+        self.lastTime[f] = lastTime
+        return True
+
+    # A snapshot file is the header, then for each filter a record, its key and its values as doubles
+    SNAPSHOT = struct.Struct("<4sdI")   # Magic, time written, number of filters
+    RECORD = struct.Struct("<HBbd")     # Key length, width, sent, last time
+
+    @classmethod
+    def pack(cls, states, now):
+        """ Packs a dict of key -> state() into the bytes of a snapshot file """
+        parts = [cls.SNAPSHOT.pack(b"DSF1", now, len(states))]
+        for key, (values, sent, lastTime) in states.items():
+            key = key.encode("utf-8")
+            parts.append(cls.RECORD.pack(len(key), len(values), sent, lastTime))
+            parts.append(key)
+            parts.append(struct.pack("<%dd" % len(values), *values))
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        """ Returns the time a snapshot was written and its dict of key -> state. Raises
+            ValueError if data is not a whole snapshot.
+        """
+        try:
+            magic, written, count = cls.SNAPSHOT.unpack_from(data, 0)
+            if magic != b"DSF1":
+                raise ValueError("not a filter snapshot")
+            offset = cls.SNAPSHOT.size
+            states = {}
+            for i in range(count):
+                length, width, sent, lastTime = cls.RECORD.unpack_from(data, offset)
+                offset += cls.RECORD.size
+                key = data[offset:offset + length].decode("utf-8")
+                offset += length
+                values = list(struct.unpack_from("<%dd" % width, data, offset))
+                offset += 8*width
+                states[key] = (values, bool(sent), lastTime)
+        except struct.error as ex:
+            raise ValueError(str(ex))
+        if offset != len(data):
+            raise ValueError("%d bytes left over" % (len(data) - offset))
+        return written, states
+
+    def remove(self, f):
+        """ Frees filter f to be reused by the next filter of the same width """
+        self.free.setdefault(len(self.values(f)), []).append(f)
+
+    def configure(self):
+        """ Takes thresholds from config. Called whenever config changes. """
+        for f, (thresholdKey, maxIntervalKey) in enumerate(self.keys):
+            self.threshold[f] = config[thresholdKey] if thresholdKey else 0.0
+            self.maxInterval[f] = config[maxIntervalKey] if maxIntervalKey else 0.0
+
+    def test(self, f, values, timeStamp):
+        """ Returns True if the sample should be sent, in which case it becomes the new reference """
+        previous = self.previous
+        start = self.start[f]
+        self.heard[f] = timeStamp
+        maxInterval = self.maxInterval[f]
+        if maxInterval and timeStamp - self.lastTime[f] > maxInterval:
+            passed = True
+        else:
+            passed = False
+            threshold = self.threshold[f]
+            slot = start
+            for v in values:
+                change = abs(v - previous[slot])
+                if change > threshold or (change == threshold and not self.strict[f]):
+                    passed = True
+                    break
+                slot += 1
+        if passed:
+            for v in values:
+                previous[start] = v
+                start += 1
+            self.lastTime[f] = timeStamp
+            self.sent[f] = True
+        return passed
+
+    def values(self, f):
+        """ The last values sent through filter f """
+        end = self.start[f + 1] if f + 1 < len(self.start) else len(self.previous)
+        return self.previous[self.start[f]:end].tolist()
+
+filters = DeadbandFilters()
+
+class KeepAliveWheel:
+    """ Re-sends the last value of any series that has not been sent for max_interval seconds,
+        as long as a sample has been heard since it was last sent. Filters are hashed into
+        slots by deadline and a single periodic tick works through the slots that have come
+        due. Deadlines are worked out from the filter table when a slot comes due, so nothing
+        has to move when a series is sent in the normal way.
+    """
+    def __init__(self, size=256):
+        self.slots = [[] for i in range(size)]
+        self.resend = {}        # filter -> function(timeStamp, values)
+        self.expiring = []      # Objects with an expire(now) method to call on every tick
+        self.position = None    # Last tick processed
+        self.configure()
+
+    def configure(self):
+        tick = getattr(self, "tick", None)
+        self.enabled = config["keepalive"]
+        self.tick = config["keepalive_tick"]
+        self.maxInterval = config["max_interval"]
+        if self.position is not None and tick != self.tick:
+            # Positions are counted in ticks, so start counting again and put everything
+            # back in the slot for its deadline in the new ticks
+            now = time.time()
+            self.position = int(now/self.tick)
+            due = [entry for slot in self.slots for entry in slot]
+            self.slots = [[] for slot in self.slots]
+            for f, resend in due:
+                if self.resend.get(f) is resend:
+                    self.schedule(f, resend, filters.lastTime[f] + self.maxInterval if filters.sent[f]
+                                  else now + self.maxInterval)
+
+    def add(self, f, resend):
+        self.resend[f] = resend
+        self.schedule(f, resend, time.time() + self.maxInterval)
+
+    def remove(self, f):
+        # Left in its slot, but skipped when the slot comes due
+        self.resend.pop(f, None)
+
+    def schedule(self, f, resend, deadline):
+        tick = int(deadline/self.tick)
+        if self.position is not None and tick <= self.position:
+            tick = self.position + 1
+        self.slots[tick % len(self.slots)].append((f, resend))
+
+    def start(self):
+        if self.position is None:
+            self.position = int(time.time()/self.tick)
+            reactor.callLater(self.tick, self.onTick)
+
+    def onTick(self):
+        now = time.time()
+        current = int(now/self.tick)
+        # Each slot need only be visited once however late the tick is
+        self.position = max(self.position, current - len(self.slots))
+        while self.position < current:
+            self.position += 1
+            index = self.position % len(self.slots)
+            due = self.slots[index]
+            self.slots[index] = []
+            for f, resend in due:
+                if self.resend.get(f) is not resend:
+                    # Removed, or removed and reused by another series
+                    continue
+                if not filters.sent[f]:
+                    deadline = now + self.maxInterval
+                else:
+                    deadline = filters.lastTime[f] + self.maxInterval
+                    if deadline <= now:
+                        # Nothing heard since the last send means the sensor has gone quiet,
+                        # so wait for it rather than sending its last value again
+                        if self.enabled and filters.heard[f] > filters.lastTime[f]:
+                            filters.lastTime[f] = now
+                            resend(now, filters.values(f))
+                        deadline = now + self.maxInterval
+                self.schedule(f, resend, deadline)
+        for e in self.expiring:
+            e.expire(now)
+        reactor.callLater(self.tick, self.onTick)
+
+# Values that need converting before they are filtered and sent
+TRANSFORMS = {
+    "on":   lambda v: 1 if v == "on" else 0,
+    "bool": lambda v: 1 if v else 0
+}
+
+# How each characteristic is processed. Others can be added, or these replaced, in
+# config["characteristics"]. Keys:
+#   enable:       config key that turns the characteristic on
+#   series:       series name suffix, or prefix if there are axes
+#   axes:         keys into the data for characteristics with several values, each
+#                 either a key or [key, series name]
+#   transform:    applied to each value, from TRANSFORMS
+#   min_change:   config key for the deadband threshold. Without one, any change is sent
+#   strict:       a change must be more than min_change, rather than at least min_change
+#   max_interval: config key for the longest time between values being sent
+#   polling:      config key for the polling interval requested from adaptors
+#   filter:       false to send every value
+#   new_time:     only send values with a different time stamp to the last one sent
+CHARACTERISTICS = {
+    "temperature":    {"enable": "temperature", "series": "/temperature", "min_change": "temp_min_change",
+                       "polling": "temperature_polling_interval"},
+    "ir_temperature": {"enable": "irtemperature", "series": "/ir_temperature", "min_change": "irtemp_min_change",
+                       "polling": "temperature_polling_interval"},
+    "acceleration":   {"enable": "accel", "series": "/accel/", "axes": ["x", "y", "z"],
+                       "min_change": "accel_min_change", "strict": True, "polling": "accel_polling_interval"},
+    "gyro":           {"enable": "gyro", "series": "/gyro/", "axes": ["x", "y", "z"],
+                       "min_change": "gyro_min_change", "strict": True, "polling": "gyro_polling_interval"},
+    "magnetometer":   {"enable": "magnet", "series": "/magnet/", "axes": ["x", "y", "z"],
+                       "min_change": "magnet_min_change", "strict": True, "polling": "magnet_polling_interval"},
+    "buttons":        {"enable": "buttons", "series": "/",
+                       "axes": [["leftButton", "left_button"], ["rightButton", "right_button"]],
+                       "transform": "bool", "filter": False},
+    "humidity":       {"enable": "humidity", "series": "/humidity", "min_change": "humidity_min_change",
+                       "polling": "humidity_polling_interval"},
+    "binary_sensor":  {"enable": "binary", "series": "/binary", "transform": "on", "strict": True,
+                       "new_time": True},
+    "power":          {"enable": "power", "series": "/power", "min_change": "power_min_change",
+                       "polling": "power_polling_interval"},
+    "battery":        {"enable": "battery", "series": "/battery", "min_change": "battery_min_change",
+                       "max_interval": "max_interval", "polling": "battery_polling_interval"},
+    "connected":      {"enable": "connected", "series": "/connected", "transform": "bool", "strict": True,
+                       "max_interval": "max_interval"},
+    "luminance":      {"enable": "luminance", "series": "/luminance", "min_change": "luminance_min_change",
+                       "polling": "luminance_polling_interval"}
+}
+
+def characteristics(settings):
+    """ CHARACTERISTICS with any additions and replacements from settings (ie: config) """
+    schemas = dict(CHARACTERISTICS)
+    schemas.update(settings.get("characteristics", {}))
+    return schemas
+
+class Processor(object):
+    """ Filters and stores one characteristic from one adaptor, as described by its schema """
+    __slots__ = ("id", "get", "suffixes", "transform", "filter", "newTime", "received", "passed",
+                 "sum", "sumSquares", "characteristic", "dm", "cbLog", "log")
+
+    def __init__(self, id, schema):
         self.id = id
+        self.get, self.suffixes = self.layout(schema)
+        self.transform = TRANSFORMS[schema["transform"]] if "transform" in schema else None
+        self.newTime = schema.get("new_time", False)
+        self.resetCounts()
+        if schema.get("filter", True):
+            maxInterval = schema.get("max_interval")
+            self.filter = filters.add(len(self.suffixes), schema.get("min_change"), strict=schema.get("strict", False),
+                                      maxIntervalKey=maxInterval, lastTime=time.time() if maxInterval else 0.0)
+        else:
+            self.filter = None
+
+    layouts = {}
+    counting = False    # Whether to keep counts for adaptive polling
 
-    def processAccel(self, resp):
-        accel = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
+    @classmethod
+    def layout(cls, schema):
+        """ A function that gets a tuple of values from the data (None for a single value)
+            and the series suffixes, shared between processors
+        """
+        axes = schema.get("axes")
+        key = (schema["series"], tuple(tuple(a) if isinstance(a, list) else a for a in axes or ()))
+        if key not in cls.layouts:
+            if axes:
+                axes = [a if isinstance(a, list) else [a, a] for a in axes]
+                if len(axes) == 1:
+                    get = lambda data, k=axes[0][0]: (data[k],)
+                else:
+                    get = itemgetter(*[a[0] for a in axes])
+                cls.layouts[key] = (get, tuple(schema["series"] + a[1] for a in axes))
+            else:
+                cls.layouts[key] = (None, (schema["series"],))
+        return cls.layouts[key]
+
+    def process(self, resp):
         timeStamp = resp["timeStamp"]
-        event = False
-        for a in range(3):
-            if abs(accel[a] - self.previous[a]) > config["accel_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeAccel(self.id, timeStamp, accel)
-            self.previous = accel
+        values = resp["data"]
+        if self.get is None:
+            values = (values,) if self.transform is None else (self.transform(values),)
+        else:
+            values = self.get(values)
+            if self.transform is not None:
+                values = [self.transform(v) for v in values]
+        f = self.filter
+        if self.counting:
+            v = values[0]
+            self.received += 1
+            self.sum += v
+            self.sumSquares += v*v
+        if f is None or ((not self.newTime or timeStamp != filters.lastTime[f]) and
+                         filters.test(f, values, timeStamp)):
+            if self.counting:
+                self.passed += 1
+            self.store(timeStamp, values)
 
-class TemperatureMeasure():
-    def __init__(self, id):
-        self.id = id
-        self.prevTemp = 0.0
-        self.prevTime = time.time()
-
-    def processTemp (self, resp):
-        #self.cbLog("debug", "processTemp: " + self.id + " - " + str(resp))
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if abs(temp-self.prevTemp) >= config["temp_min_change"]:
-            self.dm.storeTemp(self.id, timeStamp, temp) 
-            self.prevTemp = temp
-            self.prevTime = timeStamp
-
-class IrTemperatureMeasure():
-    def __init__(self, id):
-        self.id = id
-        self.prevTemp = 0.0
+    def resetCounts(self):
+        self.received = 0
+        self.passed = 0
+        self.sum = 0.0
+        self.sumSquares = 0.0
 
-    def processIrTemp (self, resp):
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if abs(temp-self.prevTemp) >= config["irtemp_min_change"]:
-            self.dm.storeIrTemp(self.id, timeStamp, temp) 
-            self.prevTemp = temp
+    def store(self, timeStamp, values):
+        names = self.dm.names[self.id]
+        storeValues = self.dm.storeValues
+        characteristic = self.characteristic
+        for suffix, v in zip(self.suffixes, values):
+            storeValues(names[suffix], timeStamp, v, characteristic)
 
-class Buttons():
-    def __init__(self, id):
-        self.id = id
+    def resend(self, timeStamp, values):
+        if self.transform is not None:
+            values = [int(v) for v in values]
+        self.store(timeStamp, values)
 
-    def processButtons(self, resp):
-        timeStamp = resp["timeStamp"] 
-        buttons = resp["data"]
-        self.dm.storeButtons(self.id, timeStamp, buttons)
+class Aggregate:
+    """ Sends the min, max, mean (and optionally RMS) of each axis and the number of samples
+        over fixed windows, instead of individual samples. Windows are aligned to multiples
+        of the window length and time stamped with their start.
+    """
+    __slots__ = ("id", "window", "suffixes", "countSuffix", "start", "count",
+                 "min", "max", "sum", "sumSquares", "characteristic", "dm", "cbLog", "log")
 
-class Gyro():
-    def __init__(self, id):
+    def __init__(self, id, prefix, window, rms):
         self.id = id
-        self.previous = [0.0, 0.0, 0.0]
+        self.window = window
+        stats = ("/min", "/max", "/mean", "/rms") if rms else ("/min", "/max", "/mean")
+        self.suffixes = [[prefix + axis + s for s in stats] for axis in "xyz"]
+        self.countSuffix = prefix + "count"
+        self.start = None
+        self.count = 0
 
-    def processGyro(self, resp):
-        gyro = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
-        for a in range(3):
-            if abs(gyro[a] - self.previous[a]) > config["gyro_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeGyro(self.id, timeStamp, gyro)
-            self.previous = gyro
+    def process(self, resp):
+        data = resp["data"]
+        timeStamp = resp["timeStamp"]
+        values = (data["x"], data["y"], data["z"])
+        if self.start is None or not self.start <= timeStamp < self.start + self.window:
+            if self.count:
+                self.send()
+            self.start = timeStamp - timeStamp % self.window
+            self.count = 0
+        if self.count:
+            for a in range(3):
+                v = values[a]
+                if v < self.min[a]:
+                    self.min[a] = v
+                elif v > self.max[a]:
+                    self.max[a] = v
+                self.sum[a] += v
+                self.sumSquares[a] += v*v
+        else:
+            self.min = list(values)
+            self.max = list(values)
+            self.sum = list(values)
+            self.sumSquares = [v*v for v in values]
+        self.count += 1
 
-class Magnet():
-    def __init__(self, id):
-        self.id = id
-        self.previous = [0.0, 0.0, 0.0]
+    def expire(self, now):
+        if self.count and now >= self.start + self.window:
+            self.send()
+            self.count = 0
 
-    def processMagnet(self, resp):
-        mag = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
+    def send(self):
+        names = self.dm.names[self.id]
+        storeValues = self.dm.storeValues
+        characteristic = self.characteristic
+        count = float(self.count)
         for a in range(3):
-            if abs(mag[a] - self.previous[a]) > config["magnet_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeMagnet(self.id, timeStamp, mag)
-            self.previous = mag
+            suffixes = self.suffixes[a]
+            storeValues(names[suffixes[0]], self.start, self.min[a], characteristic)
+            storeValues(names[suffixes[1]], self.start, self.max[a], characteristic)
+            storeValues(names[suffixes[2]], self.start, self.sum[a]/count, characteristic)
+            if len(suffixes) > 3:
+                storeValues(names[suffixes[3]], self.start, (self.sumSquares[a]/count)**0.5, characteristic)
+        storeValues(names[self.countSuffix], self.start, self.count, characteristic)
 
-class Humid():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0.0
-        self.prevTime = time.time()
-
-    def processHumidity (self, resp):
-        #self.cbLog("debug", "processHumidity: " + self.id + " - " + str(resp))
-        h = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(self.previous - h) >= config["humidity_min_change"]:
-            self.dm.storeHumidity(self.id, timeStamp, h) 
-            self.previous = h
-            self.prevTime = timeStamp
-
-class Binary():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
-        self.previousTime = 0
-
-    def processBinary(self, resp):
-        timeStamp = resp["timeStamp"] 
-        b = resp["data"]
-        if b == "on":
-            bi = 1
-        else:
-            bi = 0
-        if bi != self.previous:
-            if timeStamp != self.previousTime:
-                self.dm.storeBinary(self.id, timeStamp, bi)
-                self.previous = bi
-                self.previousTime = timeStamp
-
-class Luminance():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
-        self.prevTime = time.time()
+class SwingingDoor:
+    """ Sends only the points needed to rebuild a series, by joining them with straight lines,
+        to within maxError (a form of the swinging door algorithm). Each point received is held until
+        the next shows whether it is needed, or until hold seconds go by without another or
+        maxInterval seconds since the last point sent.
+    """
+    __slots__ = ("id", "suffix", "maxError", "hold", "maxInterval", "anchorTime", "anchor",
+                 "upper", "lower", "time", "value", "pending", "characteristic", "dm", "cbLog", "log")
 
-    def processLuminance(self, resp):
-        #self.cbLog("debug", "processLuminance: " + self.id + " - " + str(resp))
-        v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["luminance_min_change"]:
-            self.dm.storeLuminance(self.id, timeStamp, v) 
-            self.previous = v
-            self.prevTime = timeStamp
-
-class Power():
-    def __init__(self, id):
+    def __init__(self, id, suffix, maxError, hold, maxInterval):
         self.id = id
-        self.previous = 0
-        self.previousTime = time.time()
+        self.suffix = suffix
+        self.maxError = maxError
+        self.hold = hold
+        self.maxInterval = maxInterval
+        self.anchorTime = None
+        self.pending = False
 
-    def processPower(self, resp):
+    def process(self, resp):
+        timeStamp = resp["timeStamp"]
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["power_min_change"]:
-            self.dm.storePower(self.id, timeStamp, v) 
-            self.previous = v
-            self.previousTime = timeStamp
-
-class Battery():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
-        self.previousTime = time.time()
+        if self.anchorTime is None:
+            self.send(timeStamp, v)
+            return
+        if self.pending and timeStamp <= self.time:
+            # Adaptors can repeat a time stamp. The first value is kept, as for new_time.
+            return
+        dt = timeStamp - self.anchorTime
+        if dt <= 0:
+            return
+        slope = (v - self.anchor)/dt
+        if not self.lower <= slope <= self.upper:
+            # A line from the last point sent to this one would be too far from one in between,
+            # so the held point has to be sent and starts a new line
+            self.send(self.time, self.value)
+            dt = timeStamp - self.anchorTime
+            slope = (v - self.anchor)/dt
+        # The slopes of lines from the last point sent that pass within maxError of every point since
+        self.upper = min(self.upper, slope + self.maxError/dt)
+        self.lower = max(self.lower, slope - self.maxError/dt)
+        self.time = timeStamp
+        self.value = v
+        self.pending = True
 
-    def processBattery(self, resp):
-        v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["battery_min_change"] or timeStamp - self.previousTime > config["max_interval"]:
-            self.dm.storeBattery(self.id, timeStamp, v) 
-            self.previous = v
-            self.previousTime = timeStamp
-
-class Connected():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
-        self.previousTime = time.time()
+    def expire(self, now):
+        if self.pending and (now - self.time > self.hold or now - self.anchorTime > self.maxInterval):
+            self.send(self.time, self.value)
+
+    def send(self, timeStamp, v):
+        self.dm.storeValues(self.dm.names[self.id][self.suffix], timeStamp, v, self.characteristic)
+        self.anchorTime = timeStamp
+        self.anchor = v
+        self.upper = float("inf")
+        self.lower = float("-inf")
+        self.pending = False
+
+# Series name prefixes for characteristics that can be aggregated
+AGGREGATES = {
+    "acceleration": "/accel/",
+    "gyro":         "/gyro/",
+    "magnetometer": "/magnet/"
+}
+
+class Ring:
+    """ Queue of byte strings in shared memory, with one process writing and another reading.
+        The mmap starts with counts of the bytes written and read so far, each only changed
+        by one side, followed by a circular buffer of frames: a 32 bit length and the bytes.
+        Counts are updated after the frame itself is written or read. They are only read and
+        written holding a lock shared by both processes, which orders them with the frames on
+        processors that, unlike x86, may make stores visible out of order.
+    """
+    HEADER = 16
+    LOCK_TIMEOUT = 1.0      # In case the other side died holding the lock
+
+    def __init__(self, size):
+        self.size = size
+        self.map = mmap.mmap(-1, self.HEADER + size)
+        self.lock = multiprocessing.Lock()
+
+    def counts(self):
+        """ Bytes written and read so far, or None if the lock could not be had """
+        if not self.lock.acquire(True, self.LOCK_TIMEOUT):
+            return None
+        try:
+            return struct.unpack_from("<QQ", self.map, 0)
+        finally:
+            self.lock.release()
+
+    def setCount(self, offset, count):
+        if not self.lock.acquire(True, self.LOCK_TIMEOUT):
+            return False
+        try:
+            struct.pack_into("<Q", self.map, offset, count)
+        finally:
+            self.lock.release()
+        return True
+
+    def put(self, data):
+        """ Returns False if there is no room """
+        counts = self.counts()
+        if counts is None:
+            return False
+        written, read = counts
+        frame = struct.pack("<I", len(data)) + data
+        if len(frame) > self.size - (written - read):
+            return False
+        start = written % self.size
+        first = min(len(frame), self.size - start)
+        self.map[self.HEADER + start:self.HEADER + start + first] = frame[:first]
+        if first < len(frame):
+            self.map[self.HEADER:self.HEADER + len(frame) - first] = frame[first:]
+        return self.setCount(0, written + len(frame))
+
+    def read(self, position, n):
+        start = position % self.size
+        first = min(n, self.size - start)
+        data = self.map[self.HEADER + start:self.HEADER + start + first]
+        if first < n:
+            data += self.map[self.HEADER:self.HEADER + n - first]
+        return data
+
+    def get(self):
+        """ Returns the oldest frame, or None if there isn't one """
+        counts = self.counts()
+        if counts is None or counts[0] == counts[1]:
+            return None
+        read = counts[1]
+        n = struct.unpack("<I", self.read(read, 4))[0]
+        data = self.read(read + 4, n)
+        if not self.setCount(8, read + 4 + n):
+            return None
+        return data
+
+class RingClient:
+    """ Stands in for CbClient in shard workers, passing data messages back to the app """
+    def __init__(self, ring, cid):
+        self.ring = ring
+        self.cid = cid
+        self.parent = os.getppid()
+
+    def send(self, msg):
+        frame = marshal.dumps((self.cid, msg))
+        while not self.ring.put(frame):
+            if os.getppid() != self.parent:
+                os._exit(0)
+            time.sleep(0.001)
+
+    def receive(self, message):
+        pass
+
+    def save(self):
+        pass
+
+    def loadSaved(self):
+        pass
+
+class WorkerCall:
+    def __init__(self, when, f, args):
+        self.when = when
+        self.f = f
+        self.args = args
+        self.live = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def active(self):
+        return self.live
+
+    def cancel(self):
+        self.live = False
+
+class WorkerReactor:
+    """ Stands in for the twisted reactor in shard workers """
+    def __init__(self):
+        self.calls = []
+
+    def callLater(self, delay, f, *args):
+        call = WorkerCall(time.time() + delay, f, args)
+        heapq.heappush(self.calls, call)
+        return call
+
+    def runDue(self):
+        """ Runs the calls that are due and returns the time until the next one """
+        now = time.time()
+        while self.calls and self.calls[0].when <= now:
+            call = heapq.heappop(self.calls)
+            if call.live:
+                call.live = False
+                call.f(*call.args)
+        return self.calls[0].when - now if self.calls else 1.0
+
+class Shards:
+    """ Worker processes that each filter, aggregate and encode the data from a share of the
+        adaptors, forked from the app once it is configured. Adaptor messages are passed to
+        workers in batches through one Ring each, and data messages for the client come back
+        through another.
+    """
+    BATCH = 64              # Messages
+    MAX_QUEUED = 64*64      # Messages held for a worker whose ring is full
+    DRAIN_INTERVAL = 0.05
+
+    def __init__(self, app, count, ringBytes):
+        self.app = app
+        self.count = count
+        self.ringBytes = ringBytes
+        self.shard = {}     # adaptor id -> worker
+        self.queues = [[] for i in range(count)]
+        self.inbound = [None]*count
+        self.outbound = [None]*count
+        self.pids = [None]*count
+        self.restarts = 0
+        self.flushCall = None
+        for i in range(count):
+            self.start(i)
+
+    def start(self, i):
+        """ Forks worker i, with new rings. It starts with a copy of the app as it is now. """
+        inbound = Ring(self.ringBytes)
+        outbound = Ring(self.ringBytes)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self.app.runWorker(inbound, outbound)
+            except BaseException:
+                self.app.log("error", "Worker %d failed: %s", os.getpid(), traceback.format_exc())
+                status = 1
+            finally:
+                os._exit(status)
+        self.inbound[i] = inbound
+        self.outbound[i] = outbound
+        self.pids[i] = pid
+
+    @staticmethod
+    def exited(pid):
+        try:
+            return os.waitpid(pid, os.WNOHANG)[0] != 0
+        except OSError:
+            return True # Already waited for
+
+    def reap(self):
+        """ Starts a new worker in place of any that has exited. Its adaptors announce their
+            services to it again, as the old worker's processors are lost.
+        """
+        for i, pid in enumerate(self.pids):
+            if self.exited(pid):
+                self.app.log("error", "Worker %d for shard %d exited. Starting another", pid, i)
+                self.drainRing(self.outbound[i])
+                self.restarts += 1
+                self.start(i)
+                for adaptorID in sorted(a for a, shard in self.shard.items() if shard == i):
+                    if adaptorID in self.app.offered:
+                        self.queue(i, "s", {"id": adaptorID, "service": [{"characteristic": c}
+                                                                          for c in self.app.offered[adaptorID]]})
+
+    def forward(self, adaptorID, kind, payload):
+        try:
+            i = self.shard[adaptorID]
+        except KeyError:
+            i = self.shard[adaptorID] = zlib.crc32(adaptorID.encode("utf-8")) % self.count
+        self.queue(i, kind, payload)
+
+    def broadcast(self, kind, payload):
+        for i in range(self.count):
+            self.queue(i, kind, payload)
+
+    def queue(self, i, kind, payload):
+        queue = self.queues[i]
+        queue.append((kind, payload))
+        if len(queue) >= self.BATCH:
+            self.flush(i)
+        elif self.flushCall is None:
+            self.flushCall = reactor.callLater(0, self.flushAll)
+
+    def flush(self, i):
+        queue = self.queues[i]
+        if self.inbound[i].put(marshal.dumps(queue)):
+            self.queues[i] = []
+            return True
+        if len(queue) > self.MAX_QUEUED:
+            kept = [m for m in queue if m[0] != "d"]
+            self.app.dropped += len(queue) - len(kept)
+            self.queues[i] = kept
+        return False
+
+    def flushAll(self):
+        self.flushCall = None
+        for i in range(self.count):
+            if self.queues[i] and not self.flush(i) and self.flushCall is None:
+                self.flushCall = reactor.callLater(0.01, self.flushAll)
+
+    def drain(self):
+        for ring in self.outbound:
+            self.drainRing(ring)
+
+    def drainRing(self, ring):
+        while True:
+            frame = ring.get()
+            if frame is None:
+                break
+            cid, msg = marshal.loads(frame)
+            self.app.deliver(cid, msg)
+
+    def stop(self, timeout=10):
+        """ Asks workers to send what they have and exit, and waits for them """
+        self.broadcast("x", None)
+        end = time.time() + timeout
+        running = list(self.pids)
+        while running and time.time() < end:
+            for i in range(self.count):
+                if self.queues[i]:
+                    self.flush(i)
+            self.drain()
+            for pid in list(running):
+                if self.exited(pid):
+                    running.remove(pid)
+            time.sleep(0.001)
+        self.drain()
 
-    def processConnected(self, resp):
-        v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if v:
-            b = 1
-        else:
-            b = 0
-        if b != self.previous or timeStamp - self.previousTime > config["max_interval"]:
-            self.dm.storeConnected(self.id, timeStamp, b) 
-            self.previous = b
-            self.previousTime = timeStamp
 
 class App(CbApp):
     def __init__(self, argv):
         self.appClass = "monitor"
         self.state = "stopped"
         self.status = "ok"
-        self.accel = []
-        self.gyro = []
-        self.magnet = []
-        self.temp = []
-        self.irTemp = []
-        self.buttons = []
-        self.humidity = []
-        self.binary = []
-        self.luminance = []
-        self.power = []
-        self.battery = []
-        self.connected = []
+        self.processors = {}    # (adaptor id, characteristic) -> bound process method
+        self.dropped = 0
+        self.timeSynced = False
+        self.presync = None     # (monotonic time received, message) until the clock is set
+        self.presyncDropped = 0
+        self.metrics = None
+        self.client = None
+        self.shards = None
+        self.backfills = deque()
+        self.pollingFactors = {}    # (adaptor id, characteristic) -> multiple of the polling interval
+        self.pollingCall = None
+        self.filterStates = None    # (adaptor id, characteristic) -> filter state to carry on from
+        self.configRead = False
+        self.snapshotCall = None
+        self.backfillCall = None
+        self.offered = {}       # adaptor id -> characteristics it offers
+        self.reconfigureQueue = []
+        self.reconfigureCall = None
         self.devices = []
         self.idToName = {} 
         self.dm = DataManager()
+        self.router = Router(self.dm)
+        self.log = Log(self.cbLog)
+        persistence.log = self.log
+        self.keepAlive = KeepAliveWheel()
         #CbApp.__init__ MUST be called
         CbApp.__init__(self, argv)
 
@@ -406,7 +1819,17 @@ class App(CbApp):
         self.sendManagerMessage(msg)
 
     def onStop(self):
-        self.client.save()
+        if self.shards is not None:
+            self.shards.stop()
+        if self.metrics is not None:
+            self.dumpStats()
+        for sink in self.router.sinks():
+            sink.client.save()
+            if sink.spool:
+                sink.spool.savePosition()
+        if self.snapshotting():
+            self.saveFilters()
+        persistence.flush()
 
     def onConcMessage(self, message):
         #self.cbLog("debug", "onConcMessage, message: " + str(json.dumps(message, indent=4)))
@@ -417,209 +1840,476 @@ class App(CbApp):
                     "m": "req_config",
                     "d": self.id
                 }
+                if config["wire_encoding"] == "binary":
+                    msg["encodings"] = [BINARY_ENCODING]
                 self.client.send(msg)
-        self.client.receive(message)
+                for sink in self.router.sinks():
+                    sink.onLinkReady()
+        for sink in self.router.extra:
+            if message.get("source") == sink.cid:
+                sink.client.receive(message)
+                break
+        else:
+            self.client.receive(message)
+        # Acknowledgements from the client may leave room to replay spooled data
+        for sink in self.router.sinks():
+            sink.replay()
 
     def onClientMessage(self, message):
-        self.cbLog("debug", "onClientMessage, message: " + str(json.dumps(message, indent=4)))
+        self.log.debug("onClientMessage, message: %s", Json(message))
         global config
+        if "encoding" in message:
+            self.dm.setEncoding(message["encoding"])
+        if message.get("m") == "backfill":
+            self.onBackfill(message)
         if "config" in message:
             if "warning" in message["config"]:
-                self.cbLog("warning", "onClientMessage: " + str(json.dumps(message["config"], indent=4)))
+                self.log("warning", "onClientMessage: %s", Json(message["config"]))
             else:
                 try:
-                    newConfig = message["config"]
+                    newConfig = validConfig(message["config"], self.log)
                     copyConfig = config.copy()
                     copyConfig.update(newConfig)
                     if copyConfig != config or not os.path.isfile(CONFIG_FILE):
                         self.cbLog("debug", "onClientMessage. Updating config from client message")
+                        previous = config
                         config = copyConfig.copy()
-                        with open(CONFIG_FILE, 'w') as f:
-                            json.dump(config, f)
+                        persistence.write(CONFIG_FILE, json.dumps(config).encode("utf-8"), backup=True)
                         self.cbLog("info", "Config updated")
-                        self.readLocalConfig()
-                        # With a new config, send init message to all connected adaptors
-                        for i in self.adtInstances:
-                            init = {
-                                "id": self.id,
-                                "appClass": self.appClass,
-                                "request": "init"
-                            }
-                            self.sendMessage(init, i)
+                        self.applyConfig()
+                        self.reconfigureAdaptors(previous)
+                        if self.shards is not None:
+                            self.shards.broadcast("c", config)
                 except Exception as ex:
-                    self.cbLog("warning", "onClientMessage, could not write to file. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
+                    self.cbLog("warning", "onClientMessage, could not apply config. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
+
+    def onBackfill(self, message):
+        """ Queues a request for history, eg: {"m": "backfill", "id": 1, "series": [names], "from": ms, "to": ms} """
+        if self.dm.history is None:
+            self.client.send({"m": "backfill", "id": message.get("id"), "error": "no history"})
+            return
+        series = message.get("series")
+        if not isinstance(series, list):
+            series = [series]
+        start = message.get("from", 0)
+        end = message.get("to", float("inf"))
+        if not series or not all(jsonType(name) == "string" for name in series):
+            error = "series should be a name or a list of names"
+        elif jsonType(start) != "number" or jsonType(end) != "number":
+            error = "from and to should be times in ms"
+        else:
+            error = None
+        if error is not None:
+            self.log("warning", "Bad backfill request: %s", Json(message))
+            self.client.send({"m": "backfill", "id": message.get("id"), "error": error})
+            return
+        for name in series:
+            self.backfills.append([message.get("id"), name, self.dm.history.find(name, start), end])
+        if self.backfillCall is None:
+            self.backfillCall = reactor.callLater(0, self.sendBackfill)
+
+    def sendBackfill(self):
+        """ Sends one chunk of the oldest backfill request, then lets the reactor get on with
+            other things before the next, waiting while the client has a backlog
+        """
+        self.backfillCall = None
+        if not self.backfills:
+            return
+        if not self.dm.linkClear():
+            self.backfillCall = reactor.callLater(1, self.sendBackfill)
+            return
+        request = self.backfills[0]
+        id, name, position, end = request
+        points, position = self.dm.history.read(name, position, config["history_chunk_points"], end)
+        if position is None:
+            self.backfills.popleft()
+        else:
+            request[2] = position
+        more = position is not None or any(r[0] == id for r in self.backfills)
+        self.client.send({"m": "backfill", "id": id, "d": [{"name": name, "points": points}], "more": more})
+        if self.backfills:
+            self.backfillCall = reactor.callLater(0, self.sendBackfill)
 
     def onAdaptorData(self, message):
         #self.cbLog("debug", "onadaptorData, message: " + str(json.dumps(message, indent=4)))
-        if not timeCorrect():
-            self.cbLog("info", "Data not processed as time is not correct")
-            return 
-        if message["characteristic"] == "acceleration":
-            for a in self.accel:
-                if a.id == self.idToName[message["id"]]: 
-                    a.processAccel(message)
-                    break
-        elif message["characteristic"] == "temperature":
-            for t in self.temp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processTemp(message)
-                    break
-        elif message["characteristic"] == "ir_temperature":
-            for t in self.irTemp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processIrTemp(message)
-                    break
-        elif message["characteristic"] == "gyro":
-            for g in self.gyro:
-                if g.id == self.idToName[message["id"]]:
-                    g.processGyro(message)
-                    break
-        elif message["characteristic"] == "magnetometer":
-            for g in self.magnet:
-                if g.id == self.idToName[message["id"]]:
-                    g.processMagnet(message)
-                    break
-        elif message["characteristic"] == "buttons":
-            for b in self.buttons:
-                if b.id == self.idToName[message["id"]]:
-                    b.processButtons(message)
-                    break
-        elif message["characteristic"] == "humidity":
-            for b in self.humidity:
-                if b.id == self.idToName[message["id"]]:
-                    b.processHumidity(message)
-                    break
-        elif message["characteristic"] == "binary_sensor":
-            for b in self.binary:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBinary(message)
-                    break
-        elif message["characteristic"] == "power":
-            for b in self.power:
-                if b.id == self.idToName[message["id"]]:
-                    b.processPower(message)
-                    break
-        elif message["characteristic"] == "battery":
-            self.cbLog("debug", "Battery, message: " + str(message))
-            for b in self.battery:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBattery(message)
-                    break
+        if not self.timeSynced:
+            if not timeCorrect():
+                self.holdPresync(message)
+                return
+            self.timeSynced = True
+            self.flushPresync()
+        if self.shards is not None:
+            self.shards.forward(message["id"], "d", message)
+            return
+        if message["characteristic"] == "battery":
+            self.log.debug("Battery, message: %s", message)
         elif message["characteristic"] == "connected":
-            self.cbLog("debug", "Connected, message: " + str(message))
-            for b in self.connected:
-                if b.id == self.idToName[message["id"]]:
-                    b.processConnected(message)
-                    break
-        elif message["characteristic"] == "luminance":
-            for b in self.luminance:
-                if b.id == self.idToName[message["id"]]:
-                    b.processLuminance(message)
-                    break
+            self.log.debug("Connected, message: %s", message)
+        process = self.processors.get((message["id"], message["characteristic"]))
+        if process is None:
+            # No processor registered for this adaptor/characteristic pair
+            self.dropped += 1
+        elif self.metrics is None:
+            process(message)
+        else:
+            start = time.time()
+            stored = self.dm.stored
+            process(message)
+            self.metrics.sample(message["characteristic"], self.idToName[message["id"]],
+                                self.dm.stored - stored, time.time() - start)
+
+    def holdPresync(self, message):
+        """ Keeps data that arrives before the clock is set, to be time stamped once it is """
+        if self.presync is None or self.presync.maxlen != config["presync_buffer"]:
+            self.presync = deque(self.presync or (), config["presync_buffer"])
+        if len(self.presync) == self.presync.maxlen:
+            self.presyncDropped += 1
+        self.presync.append((monotonic(), message))
+        self.log("info", "Time not correct. Holding %d messages until it is", len(self.presync), interval=60)
+
+    def flushPresync(self):
+        if not self.presync:
+            return
+        offset = time.time() - monotonic()
+        self.log("info", "Time is correct. Processing %s held messages, %s dropped",
+                 len(self.presync), self.presyncDropped)
+        while self.presync:
+            received, message = self.presync.popleft()
+            message["timeStamp"] = received + offset
+            self.onAdaptorData(message)
+        self.presync = None
+        for sink in self.router.sinks():
+            if sink.points:
+                sink.sendValues()
+
+    def configureMetrics(self):
+        # With workers, samples are counted in the workers, which don't report back
+        if config["metrics"] and not config["workers"]:
+            if self.metrics is None:
+                self.metrics = Metrics()
+                reactor.callLater(config["stats_interval"], self.sendStats)
+        else:
+            self.metrics = None
+        self.dm.metrics = self.metrics
+
+    def stats(self):
+        report = self.metrics.report()
+        report["dropped"] = self.dropped
+        report["presync_dropped"] = self.presyncDropped
+        report["compression"] = self.dm.compressionStats
+        report["shed"] = self.dm.shed
+        if self.dm.spool:
+            report["spool_evicted"] = self.dm.spool.evicted
+        if self.router.extra:
+            report["sinks"] = dict((sink.name, {"stored": sink.stored, "compression": sink.compressionStats,
+                                                "shed": sink.shed,
+                                                "spool_evicted": sink.spool.evicted if sink.spool else 0})
+                                   for sink in self.router.extra)
+        return report
+
+    def dumpStats(self):
+        try:
+            persistence.write(STATS_FILE, json.dumps(self.stats(), indent=4).encode("utf-8"))
+        except Exception as ex:
+            self.cbLog("warning", "Could not write stats. Type: " + str(type(ex)) + ", exception: " + str(ex.args))
+
+    def sendStats(self):
+        if self.metrics is None:
+            return
+        self.client.send({"m": "stats", "d": self.stats()})
+        self.dumpStats()
+        reactor.callLater(config["stats_interval"], self.sendStats)
+
+    def applyConfig(self):
+        """ Pushes config into the objects that keep their own copy of it """
+        self.dm.configure()
+        self.configureSinks()
+        filters.configure()
+        self.keepAlive.configure()
+        self.configureMetrics()
+        Processor.counting = self.adaptivePolling()
+        if self.adaptivePolling() and self.pollingCall is None:
+            self.pollingCall = reactor.callLater(config["polling_review_interval"], self.reviewPolling)
+        if self.snapshotting() and self.snapshotCall is None:
+            self.snapshotCall = reactor.callLater(config["filter_snapshot_interval"], self.snapshotFilters)
+
+    def configureSinks(self):
+        """ Adds, updates and removes sinks to match config["sinks"] """
+        settings = config["sinks"]
+        for sink in list(self.router.extra):
+            if sink.name not in settings or settings[sink.name].get("cid") != sink.cid:
+                self.log("info", "Removing sink %s", sink.name)
+                if sink.points:
+                    sink.sendValues()
+                sink.client.save()
+                self.router.extra.remove(sink)
+        current = dict((sink.name, sink) for sink in self.router.extra)
+        for name in sorted(settings):
+            if name in current:
+                sink = current[name]
+                sink.settings = settings[name]
+                sink.configure()
+            elif "cid" not in settings[name]:
+                self.log("warning", "Sink %s has no cid", name)
+            else:
+                self.log("info", "Adding sink %s for client %s", name, settings[name]["cid"])
+                sink = DataManager(name, settings[name], self.log)
+                sink.cbLog = self.cbLog
+                sink.linkReady = self.dm.linkReady
+                sink.client = CbClient(self.id, sink.cid, 100)
+                sink.client.onClientMessage = sink.onClientMessage
+                sink.client.sendMessage = self.sendMessage
+                sink.client.cbLog = self.cbLog
+                sink.client.loadSaved()
+                self.router.extra.append(sink)
+
+    def reconfigureAdaptors(self, previous):
+        """ Works out which characteristics a config change affects, sets up their processors
+            again straight away and renegotiates services, at reconfigure_rate adaptors per
+            second, with just the adaptors that offer them. Changes to thresholds and other
+            settings are taken care of by applyConfig.
+        """
+        changed = set(k for k in set(previous) | set(config) if previous.get(k) != config.get(k))
+        rebuild = set()
+        renegotiate = set()
+        schemas = characteristics(config)
+        previousSchemas = characteristics(previous)
+        for characteristic, schema in schemas.items():
+            enable = schema["enable"]
+            keys = set([enable, enable + "_mode", enable + "_max_error"])
+            if characteristic in AGGREGATES:
+                keys.update((enable + "_aggregate_window", "aggregate_rms"))
+            if changed & keys or schema != previousSchemas.get(characteristic):
+                rebuild.add(characteristic)
+            elif schema.get("polling") in changed:
+                renegotiate.add(characteristic)
+        # Characteristics removed from config["characteristics"]
+        rebuild.update(set(previousSchemas) - set(schemas))
+        for key in list(self.processors):
+            if key[1] in rebuild:
+                # The new processor carries on from where this one's filter left off
+                self.removeProcessor(key, keepState=True)
+        affected = rebuild | renegotiate
+        for adaptorID in sorted(self.offered):
+            if rebuild.intersection(self.offered[adaptorID]):
+                self.addProcessors(adaptorID)
+            if affected.intersection(self.offered[adaptorID]) and adaptorID not in self.reconfigureQueue:
+                self.reconfigureQueue.append(adaptorID)
+        self.log("info", "Config changed: %s. Renegotiating with %s adaptors",
+                 Joined(changed), len(self.reconfigureQueue))
+        if self.reconfigureCall is None:
+            self.reconfigure()
+
+    def reconfigure(self):
+        self.reconfigureCall = None
+        if self.reconfigureQueue:
+            self.requestServices(self.reconfigureQueue.pop(0))
+            self.reconfigureCall = reactor.callLater(1.0/config["reconfigure_rate"], self.reconfigure)
+
+    def reviewPolling(self):
+        """ Lengthens the polling interval of series that have been quiet since the last review
+            and shortens it for busy ones, within polling_min_factor and polling_max_factor of
+            the configured interval. A series is quiet if few of its samples passed its filter
+            and their standard deviation was within min_change, and busy if many passed or the
+            deviation was over twice min_change. Those in between are left as they are.
+        """
+        self.pollingCall = None
+        if not self.adaptivePolling():
+            return
+        schemas = characteristics(config)
+        changed = set()
+        for key, process in self.processors.items():
+            processor = process.__self__
+            if (not isinstance(processor, Processor) or processor.filter is None or
+                    "polling" not in schemas.get(key[1], {}) or processor.received < 3):
+                continue
+            rate = processor.passed/float(processor.received)
+            mean = processor.sum/processor.received
+            deviation = max(processor.sumSquares/processor.received - mean*mean, 0.0)**0.5
+            threshold = filters.threshold[processor.filter]
+            factor = self.pollingFactors.get(key, 1.0)
+            if rate <= config["polling_quiet_rate"] and deviation <= threshold:
+                factor = min(factor*2, config["polling_max_factor"])
+            elif rate >= config["polling_busy_rate"] or deviation > 2*threshold:
+                factor = max(factor/2, config["polling_min_factor"])
+            processor.resetCounts()
+            if factor != self.pollingFactors.get(key, 1.0):
+                self.pollingFactors[key] = factor
+                changed.add(key[0])
+        for adaptorID in sorted(changed):
+            if adaptorID not in self.reconfigureQueue:
+                self.reconfigureQueue.append(adaptorID)
+        if changed:
+            self.log("info", "Changing polling intervals for %d adaptors", len(changed))
+            if self.reconfigureCall is None:
+                self.reconfigure()
+        self.pollingCall = reactor.callLater(config["polling_review_interval"], self.reviewPolling)
+
+    def adaptivePolling(self):
+        # With workers, the processors and their counts are in the workers
+        return config["adaptive_polling"] and not config["workers"]
+
+    def snapshotting(self):
+        return config["filter_snapshot"] and not config["workers"]
+
+    def snapshotFilters(self):
+        self.snapshotCall = None
+        if not self.snapshotting():
+            return
+        if self.filterStates:
+            # Any adaptor that was going to come back would have by now, so stop carrying
+            # states from the last run forward into every snapshot
+            self.log("info", "Dropping %d filter states that were not taken up", len(self.filterStates))
+            self.filterStates.clear()
+        self.saveFilters()
+        self.snapshotCall = reactor.callLater(config["filter_snapshot_interval"], self.snapshotFilters)
+
+    def saveFilters(self):
+        """ Writes the state of every filter that has passed a value, along with any states
+            read at start that no processor has taken up yet, to FILTERS_FILE. Those are
+            dropped at the first periodic snapshot.
+        """
+        states = dict(self.filterStates or {})
+        for key, process in self.processors.items():
+            f = getattr(process.__self__, "filter", None)
+            if f is not None and filters.sent[f]:
+                states[key] = filters.state(f)
+        data = DeadbandFilters.pack(dict(("\t".join(key), state) for key, state in states.items()), time.time())
+        persistence.write(FILTERS_FILE, data)
+
+    def loadFilters(self):
+        """ Reads the filter states saved by saveFilters, unless they are older than
+            filter_snapshot_max_age (or the clock is wrong)
+        """
+        try:
+            with open(FILTERS_FILE, 'rb') as f:
+                written, states = DeadbandFilters.unpack(f.read())
+        except IOError:
+            return {}
+        except ValueError as ex:
+            self.log("warning", "Ignoring corrupt filter snapshot: %s", ex)
+            return {}
+        age = time.time() - written
+        if not 0 <= age <= config["filter_snapshot_max_age"]:
+            self.log("info", "Not restoring filters from a snapshot taken %.0f seconds ago", age)
+            return {}
+        self.log("info", "Read %d filter states", len(states))
+        return dict((tuple(key.split("\t", 1)), state) for key, state in states.items())
+
+    def removeProcessor(self, key, keepState=False):
+        processor = self.processors.pop(key).__self__
+        if getattr(processor, "filter", None) is not None:
+            if keepState and self.filterStates is not None and filters.sent[processor.filter]:
+                self.filterStates[key] = filters.state(processor.filter)
+            self.keepAlive.remove(processor.filter)
+            filters.remove(processor.filter)
+        if processor in self.keepAlive.expiring:
+            self.keepAlive.expiring.remove(processor)
+            processor.expire(float("inf"))
 
     def onAdaptorService(self, message):
-        self.cbLog("debug", "onAdaptorService, message: " + str(json.dumps(message, indent=4)))
+        self.log.debug("onAdaptorService, message: %s", Json(message))
         if self.state == "starting":
             self.setState("running")
-        serviceReq = []
+        offered = []
         for p in message["service"]:
+            if p["characteristic"] not in offered:
+                offered.append(p["characteristic"])
+        # Re-announcing keeps the processors (and filter state) already registered
+        self.offered[message["id"]] = offered
+        if self.shards is not None:
+            self.shards.forward(message["id"], "s", message)
+        self.requestServices(message["id"])
+
+    def addProcessors(self, adaptorID):
+        """ Sets up processors for the characteristics we want from those an adaptor offers,
+            if they are not set up already
+        """
+        if self.shards is not None:
+            return
+        schemas = characteristics(config)
+        for characteristic in self.offered[adaptorID]:
+            schema = schemas.get(characteristic)
+            if schema is not None and config.get(schema["enable"], False):
+                key = (adaptorID, characteristic)
+                if key not in self.processors:
+                    mode = config.get(schema["enable"] + "_mode", "deadband")
+                    if characteristic in AGGREGATES and mode == "aggregate":
+                        processor = Aggregate(self.idToName[adaptorID], AGGREGATES[characteristic],
+                                              config[schema["enable"] + "_aggregate_window"], config["aggregate_rms"])
+                        self.keepAlive.expiring.append(processor)
+                    elif mode == "swinging_door" and "axes" not in schema and "transform" not in schema:
+                        # Held points are sent if a sample is missed
+                        hold = 2*config[schema["polling"]] if "polling" in schema else config["keepalive_tick"]
+                        processor = SwingingDoor(self.idToName[adaptorID], schema["series"],
+                                                 config[schema["enable"] + "_max_error"], hold, config["max_interval"])
+                        self.keepAlive.expiring.append(processor)
+                    else:
+                        processor = Processor(self.idToName[adaptorID], schema)
+                    processor.characteristic = characteristic
+                    processor.dm = self.router
+                    processor.cbLog = self.cbLog
+                    processor.log = self.log
+                    self.processors[key] = processor.process
+                    if getattr(processor, "filter", None) is not None:
+                        if self.filterStates and key in self.filterStates:
+                            filters.restore(processor.filter, self.filterStates.pop(key))
+                        self.keepAlive.add(processor.filter, processor.resend)
+
+    def requestServices(self, adaptorID):
+        """ Asks an adaptor for the characteristics we want from those it offers """
+        self.addProcessors(adaptorID)
+        serviceReq = []
+        schemas = characteristics(config)
+        for characteristic in self.offered[adaptorID]:
             # Based on services offered & whether we want to enable them
-            if p["characteristic"] == "temperature":
-                if config["temperature"]:
-                    self.temp.append(TemperatureMeasure((self.idToName[message["id"]])))
-                    self.temp[-1].dm = self.dm
-                    self.temp[-1].cbLog = self.cbLog
-                    serviceReq.append({"characteristic": "temperature",
-                                       "interval": config["temperature_polling_interval"]})
-            elif p["characteristic"] == "ir_temperature":
-                if config["irtemperature"]:
-                    self.irTemp.append(IrTemperatureMeasure(self.idToName[message["id"]]))
-                    self.irTemp[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "ir_temperature",
-                                       "interval": config["temperature_polling_interval"]})
-            elif p["characteristic"] == "acceleration":
-                if config["accel"]:
-                    self.accel.append(Accelerometer((self.idToName[message["id"]])))
-                    serviceReq.append({"characteristic": "acceleration",
-                                       "interval": config["accel_polling_interval"]})
-                    self.accel[-1].dm = self.dm
-            elif p["characteristic"] == "gyro":
-                if config["gyro"]:
-                    self.gyro.append(Gyro(self.idToName[message["id"]]))
-                    self.gyro[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "gyro",
-                                       "interval": config["gyro_polling_interval"]})
-            elif p["characteristic"] == "magnetometer":
-                if config["magnet"]:
-                    self.magnet.append(Magnet(self.idToName[message["id"]]))
-                    self.magnet[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "magnetometer",
-                                       "interval": config["magnet_polling_interval"]})
-            elif p["characteristic"] == "buttons":
-                if config["buttons"]:
-                    self.buttons.append(Buttons(self.idToName[message["id"]]))
-                    self.buttons[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "buttons",
-                                       "interval": 0})
-            elif p["characteristic"] == "humidity":
-                if config["humidity"]:
-                    self.humidity.append(Humid(self.idToName[message["id"]]))
-                    self.humidity[-1].dm = self.dm
-                    self.humidity[-1].cbLog = self.cbLog
-                    serviceReq.append({"characteristic": "humidity",
-                                       "interval": config["humidity_polling_interval"]})
-            elif p["characteristic"] == "binary_sensor":
-                if config["binary"]:
-                    self.binary.append(Binary(self.idToName[message["id"]]))
-                    self.binary[-1].dm = self.dm
-                    self.binary[-1].cbLog = self.cbLog
-                    serviceReq.append({"characteristic": "binary_sensor",
-                                       "interval": 0})
-            elif p["characteristic"] == "power":
-                if config["power"]:
-                    self.power.append(Power(self.idToName[message["id"]]))
-                    self.power[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "power",
-                                       "interval": config["power_polling_interval"]})
-            elif p["characteristic"] == "battery":
-                if config["battery"]:
-                    self.battery.append(Battery(self.idToName[message["id"]]))
-                    self.battery[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "battery",
-                                       "interval": config["battery_polling_interval"]})
-            elif p["characteristic"] == "connected":
-                if config["connected"]:
-                    self.connected.append(Connected(self.idToName[message["id"]]))
-                    self.connected[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "connected",
-                                       "interval": 0})
-            elif p["characteristic"] == "luminance":
-                if config["luminance"]:
-                    self.luminance.append(Luminance(self.idToName[message["id"]]))
-                    self.luminance[-1].dm = self.dm
-                    self.luminance[-1].cbLog = self.cbLog
-                    serviceReq.append({"characteristic": "luminance",
-                                       "interval": config["luminance_polling_interval"]})
+            schema = schemas.get(characteristic)
+            if schema is not None and config.get(schema["enable"], False):
+                key = (adaptorID, characteristic)
+                interval = 0
+                if "polling" in schema:
+                    interval = config[schema["polling"]]
+                    if key in self.pollingFactors:
+                        interval *= self.pollingFactors[key]
+                serviceReq.append({"characteristic": characteristic, "interval": interval})
         msg = {"id": self.id,
                "request": "service",
                "service": serviceReq
               }
-        self.cbLog("debug", "onAdaptorService, responding: " + str(json.dumps(msg, indent=4)))
-        self.sendMessage(msg, message["id"])
+        self.log.debug("requestServices, sending: %s", Json(msg))
+        self.sendMessage(msg, adaptorID)
 
     def readLocalConfig(self):
         global config
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                newConfig = json.load(f)
-                self.cbLog("debug", "Read local config")
-                config.update(newConfig)
-        except Exception as ex:
-            self.cbLog("warning", "Local config does not exist or file is corrupt. Exception: " + str(type(ex)) + str(ex.args))
-        self.cbLog("debug", "Config: " + str(json.dumps(config, indent=4)))
+        newConfig = readJson(CONFIG_FILE, self.log)
+        if newConfig is None:
+            self.cbLog("info", "No local config, using defaults")
+        else:
+            self.cbLog("debug", "Read local config")
+            config.update(validConfig(newConfig, self.log))
+        self.log.debug("Config: %s", Json(config))
+
+    def releaseAdaptor(self, adaptorID):
+        """ Forgets an adaptor that is no longer connected to the app """
+        self.cbLog("debug", "releaseAdaptor: " + adaptorID)
+        for key in [k for k in self.processors if k[0] == adaptorID]:
+            self.removeProcessor(key)
+            self.pollingFactors.pop(key, None)
+        self.offered.pop(adaptorID, None)
+        if adaptorID in self.reconfigureQueue:
+            self.reconfigureQueue.remove(adaptorID)
+        self.idToName.pop(adaptorID, None)
+        self.devices.remove(adaptorID)
 
     def onConfigureMessage(self, managerConfig):
-        self.readLocalConfig()
+        if not self.configRead:
+            # Only at start. After that config is changed by the client, and the file may be
+            # waiting to be written.
+            self.readLocalConfig()
+            self.configRead = True
+        connected = set(adaptor["id"] for adaptor in managerConfig["adaptors"])
+        for adtID in [a for a in self.devices if a not in connected]:
+            self.releaseAdaptor(adtID)
         idToName2 = {}
         for adaptor in managerConfig["adaptors"]:
             adtID = adaptor["id"]
@@ -631,15 +2321,110 @@ class App(CbApp):
                 idToName2[adtID] = friendly_name
                 self.idToName[adtID] = friendly_name.replace(" ", "_")
                 self.devices.append(adtID)
-        self.client = CbClient(self.id, CID, 100)
-        self.client.onClientMessage = self.onClientMessage
-        self.client.sendMessage = self.sendMessage
-        self.client.cbLog = self.cbLog
-        self.client.loadSaved()
-        self.dm.initAddress(self.bridge_id, self.idToName)
+        if self.client is None:
+            self.client = CbClient(self.id, CID, 100)
+            self.client.onClientMessage = self.onClientMessage
+            self.client.sendMessage = self.sendMessage
+            self.client.cbLog = self.cbLog
+            self.client.loadSaved()
         self.dm.cbLog = self.cbLog
+        self.dm.log = self.log
         self.dm.client = self.client
+        self.applyConfig()
+        if self.filterStates is None:
+            self.filterStates = self.loadFilters() if self.snapshotting() else {}
+        self.keepAlive.start()
+        self.router.initAddress(self.bridge_id, self.idToName)
         self.setState("starting")
+        if self.shards is not None:
+            self.shards.broadcast("m", managerConfig)
+        elif config["workers"]:
+            self.startShards()
+
+    def startShards(self):
+        self.log("info", "Starting %s workers", config["workers"])
+        if config["metrics"] or config["adaptive_polling"]:
+            self.log("warning", "Metrics and adaptive polling are not available with workers")
+        self.shards = Shards(self, config["workers"], config["shard_ring_bytes"])
+        reactor.callLater(Shards.DRAIN_INTERVAL, self.drainShards)
+
+    def drainShards(self):
+        self.shards.drain()
+        self.shards.reap()
+        reactor.callLater(Shards.DRAIN_INTERVAL, self.drainShards)
+
+    def deliver(self, cid, msg):
+        """ Sends a data message from a worker to the client it is for """
+        for sink in self.router.extra:
+            if sink.cid == cid:
+                sink.client.send(msg)
+                return
+        self.client.send(msg)
+
+    def onWorkerConfig(self, newConfig):
+        global config
+        previous = config
+        config = newConfig
+        self.applyConfig()
+        self.reconfigureAdaptors(previous)
+
+    def runWorker(self, inbound, outbound):
+        """ Run by shard workers, in place of the reactor. Messages for adaptors and the
+            manager are dropped, as the app sends those, and data messages go back to the
+            app to be sent, rather than being spooled.
+        """
+        global reactor, CbClient, Spool
+        parent = os.getppid()
+        reactor = WorkerReactor()
+        CbClient = lambda aid, cid, keep: RingClient(outbound, cid)
+        Spool = lambda *args: None
+        self.shards = None
+        self.sendMessage = lambda msg, destination: None
+        self.sendManagerMessage = lambda msg: None
+        self.configureMetrics = lambda: None
+        self.startShards = lambda: None
+        self.metrics = None
+        self.timeSynced = True
+        self.client = CbClient(self.id, CID, 100)
+        for sink in self.router.sinks():
+            sink.client = CbClient(self.id, sink.cid, 100)
+            sink.spool = None
+            sink.encoder = None
+            sink.linkReady = True
+            sink.metrics = None
+        self.keepAlive.position = None
+        self.keepAlive.start()
+        handlers = {"d": self.onAdaptorData,
+                    "s": self.onAdaptorService,
+                    "m": self.onConfigureMessage,
+                    "c": self.onWorkerConfig
+                   }
+        def runDue():
+            try:
+                return reactor.runDue()
+            except Exception:
+                self.log("error", "Worker %d failed on a timer: %s", os.getpid(), traceback.format_exc())
+                return 0
+        while True:
+            frame = inbound.get()
+            if frame is None:
+                if os.getppid() != parent:
+                    return
+                time.sleep(max(min(runDue(), 0.005), 0))
+                continue
+            for kind, payload in marshal.loads(frame):
+                if kind == "x":
+                    for sink in self.router.sinks():
+                        if sink.points:
+                            sink.sendValues()
+                    return
+                try:
+                    handlers[kind](payload)
+                except Exception:
+                    # One bad message shouldn't cost the shard's other adaptors their data
+                    self.dropped += 1
+                    self.log("error", "Worker %d failed on %s message: %s", os.getpid(), kind, traceback.format_exc())
+            runDue()
 
 if __name__ == '__main__':
     App(sys.argv)
@@ -0,0 +1,812 @@
+#!/usr/bin/env python
+# test_data_sender.py
+# Copyright (C) ContinuumBridge Limited, 2015 - All Rights Reserved
+#
+""" Tests for data_sender.py, run off-bridge with the stand-ins for cbcommslib, cbconfig
+    and the twisted reactor from bench/bench_data_sender.py. Time is simulated in the same
+    way: reactor.advance(t) runs every call that is due by t.
+
+    Run with: python -m unittest discover tests   (or python -m pytest tests)
+"""
+
+import sys
+import os
+import base64
+import copy
+import json
+import logging
+import shutil
+import signal
+import struct
+import tempfile
+import unittest
+import zlib
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock # Python 2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+
+import bench_data_sender as bench
+
+START = 1.6e9
+CONFIG_DIR = tempfile.mkdtemp(prefix="data_sender_test")
+clock = bench.Clock(START)
+ds, reactor = bench.install(CONFIG_DIR + os.sep, clock)
+
+def tearDownModule():
+    shutil.rmtree(CONFIG_DIR, ignore_errors=True)
+
+class AppTestCase(unittest.TestCase):
+    """ Starts each test with default config (without the spool), an empty filter table,
+        nothing waiting to be written, an empty config directory and an app that has been
+        configured with adaptors A0 and A1
+    """
+    def setUp(self):
+        ds.config.clear()
+        ds.config.update(copy.deepcopy(ds.DEFAULT_CONFIG))
+        ds.config["spool"] = False
+        ds.filters = ds.DeadbandFilters()
+        ds.persistence = ds.Persistence()
+        for name in os.listdir(CONFIG_DIR):
+            os.remove(os.path.join(CONFIG_DIR, name))
+        clock.now = START
+        reactor.calls = []
+        self.sent = []          # Messages sent to the client
+        self.requests = []      # (adaptor id, message) sent to adaptors
+        self.app = self.start()
+
+    def start(self, adaptors=("A0", "A1"), ready=True):
+        app = ds.App([])
+        app.sendMessage = lambda msg, destination: self.requests.append((destination, msg))
+        app.onConfigureMessage({"adaptors": [{"id": a, "name": a, "friendly_name": "Device " + a}
+                                             for a in adaptors]})
+        if ready:
+            app.onConcMessage({"status": "ready"})
+        app.client.send = self.sent.append
+        return app
+
+    def announce(self, adaptor, *characteristics):
+        self.app.onAdaptorService({"id": adaptor, "service": [{"characteristic": c} for c in characteristics]})
+
+    def data(self, adaptor, characteristic, value, timeStamp=None):
+        self.app.onAdaptorData({"id": adaptor, "characteristic": characteristic, "data": value,
+                                "timeStamp": clock.now if timeStamp is None else timeStamp})
+
+    def advance(self, seconds):
+        reactor.advance(clock.now + seconds)
+
+    def points(self, times=False):
+        """ Series name -> values (or [time in ms, value] points) sent to the client so far """
+        points = {}
+        for msg in self.sent:
+            if msg.get("m") == "data":
+                for series in msg["d"]:
+                    points.setdefault(series["name"], []).extend(p if times else p[1] for p in series["points"])
+        return points
+
+class LoggingTest(AppTestCase):
+    def test_nothing_is_serialised_for_logs_at_info(self):
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        with mock.patch.object(ds.json, "dumps", side_effect=AssertionError("json.dumps called")) as dumps:
+            self.announce("A0", "temperature", "acceleration", "binary_sensor")
+            self.data("A0", "temperature", 21.5)
+            self.data("A0", "binary_sensor", "on")
+            self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertFalse(dumps.called)
+        self.assertEqual(self.points()["BID0/Device_A0/temperature"], [21.5])
+
+    def test_nothing_is_logged_below_the_logging_level(self):
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        self.announce("A0", "temperature")
+        with mock.patch.object(self.app, "cbLog") as cbLog:
+            self.app.log.cbLog = cbLog
+            self.app.onClientMessage({"config": {"temp_min_change": 0.5, "sinks": {"dash": {"cid": "CID2"}}}})
+            self.app.onClientMessage({"config": {"sinks": {}}})
+        # Only fixed messages, which cost nothing to build, get as far as cbLog
+        self.assertEqual(set(args for args, kwargs in cbLog.call_args_list if args[0] == "info"),
+                         set([("info", "Config updated")]))
+
+class ReconfigureTest(AppTestCase):
+    def test_processors_are_rebuilt_before_services_are_renegotiated(self):
+        adaptors = ["A%d" % i for i in range(50)]
+        self.app = self.start(adaptors)
+        for a in adaptors:
+            self.announce(a, "temperature")
+        del self.requests[:]
+        self.app.onClientMessage({"config": {"temperature_mode": "swinging_door"}})
+        for second in range(10):
+            for a in adaptors:
+                self.data(a, "temperature", 20.0 + second)
+            self.advance(1)
+        self.assertEqual(self.app.dropped, 0)
+        self.assertTrue(all(isinstance(self.app.processors[(a, "temperature")].__self__, ds.SwingingDoor)
+                            for a in adaptors))
+        # Service requests still go out at reconfigure_rate
+        self.assertEqual(len(self.requests), 10*ds.config["reconfigure_rate"])
+
+    def test_rebuilt_filters_carry_on(self):
+        self.announce("A0", "temperature")
+        self.data("A0", "temperature", 20.0)
+        self.app.onClientMessage({"config": {"characteristics": {"temperature": dict(ds.CHARACTERISTICS["temperature"],
+                                                                                      series="/temp")}}})
+        self.data("A0", "temperature", 20.05)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.0]})
+
+CO2 = {"enable": "co2", "series": "/carbon_dioxide", "min_change": "co2_min_change"}
+
+class CharacteristicTest(AppTestCase):
+    """ Sinks and shedding work on characteristics, whatever their series are called """
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config.update({"buttons": True, "co2": True, "co2_min_change": 10, "characteristics": {"co2": CO2}})
+
+    def test_sink_characteristics(self):
+        ds.config["sinks"] = {"dash": {"cid": "CID2", "characteristics": ["buttons", "co2"]}}
+        self.app = self.start()
+        dash = []
+        self.app.router.extra[0].client.send = dash.append
+        self.announce("A0", "buttons", "co2", "temperature")
+        self.data("A0", "buttons", {"leftButton": True, "rightButton": False})
+        self.data("A0", "co2", 400)
+        self.data("A0", "temperature", 20.0)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        names = sorted(series["name"] for msg in dash if msg.get("m") == "data" for series in msg["d"])
+        self.assertEqual(names, ["BID0/Device_A0/carbon_dioxide", "BID0/Device_A0/left_button",
+                                 "BID0/Device_A0/right_button"])
+
+    def test_shed_keep(self):
+        ds.config.update({"high_water_points": 2, "shed_ratio": 1000, "shed_keep": ["buttons"]})
+        self.app = self.start()
+        self.announce("A0", "buttons", "co2")
+        for i in range(5):
+            self.data("A0", "co2", 400 + 100*i)
+            self.data("A0", "buttons", {"leftButton": i % 2 == 0, "rightButton": False})
+        self.assertEqual(self.app.dm.shed, {"co2": 4})
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(len(self.points()["BID0/Device_A0/left_button"]), 5)
+
+class SchemaTest(AppTestCase):
+    BAD = {"co2": {"enable": "co2", "series": "/co2", "min_change": "co2_min_change"},
+           "noise": {"enable": "noise", "series": "/noise", "transform": "decibels"}}
+
+    def assertBuiltInsStillWork(self):
+        self.announce("A0", "co2", "noise", "temperature")
+        self.assertEqual([key for key in self.app.processors], [("A0", "temperature")])
+        self.assertEqual(self.requests[-1][1]["service"], [{"characteristic": "temperature", "interval": 300}])
+
+    def test_bad_characteristics_from_the_client_are_ignored(self):
+        with self.assertLogs(level="WARNING") as logs:
+            self.app.onClientMessage({"config": {"co2": True, "noise": True, "characteristics": self.BAD}})
+        self.assertEqual(ds.config["characteristics"], {})
+        self.assertEqual(len([line for line in logs.output if "Ignoring characteristic" in line]), 2)
+        self.assertBuiltInsStillWork()
+
+    def test_bad_characteristics_in_the_config_file_are_ignored(self):
+        with open(ds.CONFIG_FILE, "w") as f:
+            json.dump({"co2": True, "noise": True, "characteristics": self.BAD}, f)
+        self.app = self.start()
+        self.assertEqual(ds.config["characteristics"], {})
+        self.assertBuiltInsStillWork()
+
+    def test_a_characteristic_is_dropped_when_a_key_it_names_goes_bad(self):
+        co2 = {"enable": "co2", "series": "/co2", "min_change": "co2_min_change"}
+        self.app.onClientMessage({"config": {"co2": True, "co2_min_change": 10, "characteristics": {"co2": co2}}})
+        self.assertEqual(ds.config["characteristics"], {"co2": co2})
+        self.app.onClientMessage({"config": {"co2_min_change": "lots"}})
+        self.assertEqual(ds.config["characteristics"], {})
+
+class ShardsTest(AppTestCase):
+    """ Workers are forked for real. Their clock doesn't move, so they send data when stopped. """
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["workers"] = 2
+        self.app = self.start(["A%d" % i for i in range(4)])
+        self.addCleanup(self.app.shards.stop)
+        for i in range(4):
+            self.announce("A%d" % i, "temperature")
+
+    def test_a_bad_message_does_not_stop_a_worker(self):
+        self.data("A0", "temperature", "hot")
+        for i in range(4):
+            self.data("A%d" % i, "temperature", 20.0)
+        self.app.shards.stop()
+        self.assertEqual(sorted(self.points()), ["BID0/Device_A%d/temperature" % i for i in range(4)])
+
+    def test_metrics_and_adaptive_polling_are_off_with_workers(self):
+        self.app.shards.stop()
+        ds.config.update({"metrics": True, "adaptive_polling": True})
+        with self.assertLogs(level="WARNING") as logs:
+            self.app = self.start()
+        self.addCleanup(self.app.shards.stop)
+        self.assertIsNone(self.app.metrics)
+        self.assertIsNone(self.app.pollingCall)
+        self.assertIn("Metrics and adaptive polling are not available with workers", "".join(logs.output))
+
+    def test_a_worker_that_exits_is_replaced(self):
+        shard = self.app.shards.shard["A0"]
+        pid = self.app.shards.pids[shard]
+        os.kill(pid, signal.SIGKILL)
+        for attempt in range(1000):
+            self.app.drainShards()
+            if self.app.shards.restarts:
+                break
+            bench._time.sleep(0.005)
+        self.assertEqual(self.app.shards.restarts, 1)
+        self.assertNotEqual(self.app.shards.pids[shard], pid)
+        for i in range(4):
+            self.data("A%d" % i, "temperature", 20.0)
+        self.app.shards.stop()
+        self.assertEqual(sorted(self.points()), ["BID0/Device_A%d/temperature" % i for i in range(4)])
+
+class RingTest(unittest.TestCase):
+    def test_frames_come_out_in_order_around_the_end(self):
+        ring = ds.Ring(64)
+        for i in range(20):
+            self.assertTrue(ring.put(b"frame %d" % i))
+            self.assertEqual(ring.get(), b"frame %d" % i)
+        self.assertIsNone(ring.get())
+
+    def test_a_lock_left_held_by_a_dead_worker_does_not_hang(self):
+        ring = ds.Ring(64)
+        ring.put(b"frame")
+        ring.lock.acquire()
+        with mock.patch.object(ds.Ring, "LOCK_TIMEOUT", 0.01):
+            self.assertFalse(ring.put(b"another"))
+            self.assertIsNone(ring.get())
+
+class BackfillTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["history_points"] = 100
+        self.app = self.start()
+        self.announce("A0", "temperature")
+        self.data("A0", "temperature", 20.0)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        del self.sent[:]
+
+    def backfill(self, request):
+        self.app.onClientMessage(dict(request, m="backfill", id=7))
+        self.advance(1)
+        return [msg for msg in self.sent if msg.get("m") == "backfill"]
+
+    def test_backfill(self):
+        replies = self.backfill({"series": "BID0/Device_A0/temperature"})
+        self.assertEqual(replies, [{"m": "backfill", "id": 7, "more": False,
+                                    "d": [{"name": "BID0/Device_A0/temperature", "points": [[START*1000, 20.0]]}]}])
+
+    def test_only_the_most_recently_used_maps_are_kept_open(self):
+        history = self.app.dm.history = ds.History(100, CONFIG_DIR + os.sep, maxOpen=4)
+        for i in range(10):
+            self.app.dm.storeValues("BID0/Device_A0/s%d" % i, START + i, float(i), "temperature")
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(len(history.buffers), 4)
+        del self.sent[:]
+        self.assertEqual(self.backfill({"series": "BID0/Device_A0/s0"})[0]["d"],
+                         [{"name": "BID0/Device_A0/s0", "points": [[START*1000, 0.0]]}])
+
+    def test_a_batch_that_fails_to_send_is_kept_for_backfill_and_not_sent_again(self):
+        self.data("A0", "temperature", 21.0)
+        with mock.patch.object(self.app.dm, "transmit", side_effect=IOError("link down")):
+            with self.assertRaises(IOError):
+                self.app.dm.sendValues()
+        self.data("A0", "temperature", 22.0)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [22.0]})
+        del self.sent[:]
+        t = (START + ds.config["data_send_delay_max"] + 1)*1000
+        self.assertEqual(self.backfill({"series": "BID0/Device_A0/temperature"})[0]["d"][0]["points"],
+                         [[START*1000, 20.0], [t, 21.0], [t, 22.0]])
+
+    def test_bad_requests_get_an_error(self):
+        for request in ({}, {"series": []}, {"series": ["BID0/Device_A0/temperature", 3]},
+                        {"series": "BID0/Device_A0/temperature", "from": "yesterday"}):
+            del self.sent[:]
+            replies = self.backfill(request)
+            self.assertEqual(len(replies), 1)
+            self.assertEqual(replies[0]["id"], 7)
+            self.assertIn("error", replies[0])
+
+class SwingingDoorTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["temperature_mode"] = "swinging_door"
+        self.app = self.start()
+        self.announce("A0", "temperature")
+
+    def test_repeated_time_stamps_are_ignored(self):
+        for t, v in ((0, 20.0), (10, 20.0), (10, 25.0), (5, 30.0), (20, 20.0), (30, 24.0)):
+            self.data("A0", "temperature", v, timeStamp=START + t)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(self.app.dropped, 0)
+        self.assertEqual(self.points(times=True)["BID0/Device_A0/temperature"],
+                         [[START*1000, 20.0], [(START + 20)*1000, 20.0]])
+
+class Stalled:
+    """ A deferToThread result for a write that hasn't happened yet """
+    def addErrback(self, f, *args):
+        return self
+
+    def addCallback(self, f, *args):
+        return self
+
+class ConfigTest(AppTestCase):
+    def test_configure_message_keeps_client_config_while_it_is_written(self):
+        with open(ds.CONFIG_FILE, "w") as f:
+            json.dump({"temp_min_change": 0.5}, f)
+        self.app = self.start()
+        self.assertEqual(ds.config["temp_min_change"], 0.5)
+        writes = []
+        def deferToThread(f, fileName, sequence, data, backup):
+            writes.append((fileName, data))
+            return Stalled()
+        with mock.patch.object(ds.threads, "deferToThread", deferToThread):
+            self.app.onClientMessage({"config": {"temp_min_change": 0.7}})
+            self.app.onConfigureMessage({"adaptors": [{"id": "A0", "name": "A0", "friendly_name": "Device A0"}]})
+        self.assertEqual(ds.config["temp_min_change"], 0.7)
+        self.assertEqual([(fileName, json.loads(data.decode("utf-8"))["temp_min_change"]) for fileName, data in writes],
+                         [(ds.CONFIG_FILE, 0.7)])
+
+    def test_values_that_must_be_more_than_0_are_ignored_if_not(self):
+        bad = {"keepalive_tick": 0, "shed_ratio": 0, "reconfigure_rate": -1, "stats_interval": 0,
+               "temperature_polling_interval": 0, "accel_aggregate_window": 0, "co2_polling_interval": 0.0}
+        with self.assertLogs(level="WARNING") as logs:
+            self.app.onClientMessage({"config": dict(bad, temp_min_change=0, high_water_points=0)})
+        self.assertEqual(len(logs.output), len(bad))
+        for key in bad:
+            self.assertEqual(ds.config.get(key), ds.DEFAULT_CONFIG.get(key))
+        self.assertEqual((ds.config["temp_min_change"], ds.config["high_water_points"]), (0, 0))
+
+class WallClock:
+    """ A time module without monotonic(), as on Python 2 """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class PresyncTest(AppTestCase):
+    def test_held_data_is_stamped_from_a_monotonic_clock_without_time_monotonic(self):
+        wall = WallClock(1000.0)   # Before the clock is set
+        elapsed = [50.0]
+        with mock.patch.object(ds, "time", wall), \
+                mock.patch.object(ds.os, "times", lambda: (0.0, 0.0, 0.0, 0.0, elapsed[0])):
+            self.announce("A0", "temperature")
+            self.data("A0", "temperature", 20.0, timeStamp=wall.now)
+            wall.now += 10
+            elapsed[0] += 10
+            self.data("A0", "temperature", 21.0, timeStamp=wall.now)
+            wall.now = START + 100
+            elapsed[0] += 50
+            self.data("A0", "temperature", 22.0, timeStamp=wall.now)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(self.points(times=True)["BID0/Device_A0/temperature"],
+                         [[(START + 40)*1000, 20.0], [(START + 50)*1000, 21.0], [(START + 100)*1000, 22.0]])
+
+class BatchingTest(AppTestCase):
+    """ Values stored straight into the primary DataManager """
+    def configure(self, **settings):
+        ds.config.update(settings)
+        self.app.dm.configure()
+        return self.app.dm
+
+    def store(self, n, series=1):
+        for i in range(n):
+            self.app.dm.storeValues("BID0/Device_A0/s%d" % (i % series), clock.now, float(i), "temperature")
+
+    def batches(self):
+        return [sum(len(series["points"]) for series in msg["d"]) for msg in self.sent if msg.get("m") == "data"]
+
+    def test_full_batches_are_sent_at_once(self):
+        self.configure(max_batch_points=5)
+        self.store(12)
+        self.assertEqual(self.batches(), [5, 5])
+        self.advance(ds.config["data_send_delay"])
+        self.assertEqual(self.batches(), [5, 5, 2])
+
+    def test_batches_are_sent_when_they_reach_max_batch_bytes(self):
+        self.configure(max_batch_bytes=2*ds.SERIES_BYTES + 4*ds.POINT_BYTES + 2*len("BID0/Device_A0/s0"))
+        self.store(4, series=2)
+        self.assertEqual(self.batches(), [4])
+
+    def test_delay_is_kept_within_min_and_max(self):
+        self.assertEqual(self.configure(data_send_delay=100).delay, ds.config["data_send_delay_max"])
+        self.assertEqual(self.configure(data_send_delay=0.01).delay, ds.config["data_send_delay_min"])
+        self.store(1)
+        self.advance(ds.config["data_send_delay_min"] - 0.1)
+        self.assertEqual(self.batches(), [])
+        self.advance(0.1)
+        self.assertEqual(self.batches(), [1])
+
+    def test_adaptive_delay_halves_when_full_and_doubles_when_sparse(self):
+        dm = self.configure(data_send_delay_adaptive=True, data_send_delay=4, max_batch_points=100)
+        self.store(100)
+        self.assertEqual(dm.delay, 2)
+        self.store(100)
+        self.store(100)
+        self.assertEqual(dm.delay, ds.config["data_send_delay_min"])
+        # Fewer than a tenth of max_batch_points when the timer fires
+        for delay in (1, 2, 4, 8, 10, 10):
+            self.store(1)
+            self.advance(dm.delay)
+            self.assertEqual(dm.delay, delay)
+        # Between a tenth and full keeps the delay
+        self.store(50)
+        self.advance(dm.delay)
+        self.assertEqual(dm.delay, 10)
+        self.assertEqual(self.batches(), [100]*3 + [1]*6 + [50])
+
+class SpoolTest(AppTestCase):
+    """ The client holds on to what it is sent, as CbClient does until messages are acknowledged """
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config.update({"spool": True, "spool_client_backlog": 2})
+        self.app = self.start(ready=False)
+        self.unacknowledged = self.app.client.messages
+        self.app.client.send = self.send
+        self.announce("A0", "temperature")
+
+    def send(self, msg):
+        self.sent.append(msg)
+        if msg.get("m") == "data":
+            self.unacknowledged.append(msg)
+
+    def batches(self, n, first=20.0):
+        """ n batches of one temperature each, first, first + 1.0 and so on """
+        for i in range(n):
+            self.data("A0", "temperature", first + i)
+            self.advance(ds.config["data_send_delay"])
+
+    def acknowledge(self):
+        del self.unacknowledged[:]
+        self.app.onConcMessage({"source": ds.CID})
+
+    def test_data_is_spooled_until_the_link_is_ready_and_replayed_in_order(self):
+        self.batches(3)
+        self.assertEqual(self.points(), {})
+        self.assertTrue(os.path.isfile(ds.CB_CONFIG_DIR + ds.SPOOL_PREFIX + "0"))
+        self.app.onConcMessage({"status": "ready"})
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.0, 21.0]})
+        # New batches queue behind those still spooled
+        self.batches(1, 23.0)
+        self.acknowledge()
+        self.acknowledge()
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.0, 21.0, 22.0, 23.0]})
+        self.assertTrue(self.app.dm.spool.empty())
+
+    def test_replay_resumes_from_the_saved_position_after_a_restart(self):
+        self.batches(4)
+        self.app.onConcMessage({"status": "ready"})
+        self.app.onStop()
+        del self.sent[:]
+        del self.unacknowledged[:]
+        self.app = self.start(ready=False)
+        self.app.client.send = self.send
+        self.app.onConcMessage({"status": "ready"})
+        self.acknowledge()
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [22.0, 23.0]})
+
+    def test_oldest_segments_are_evicted_at_spool_max_bytes(self):
+        line = len(json.dumps({"n": 10})) + 1
+        spool = ds.Spool(CONFIG_DIR, "spool_test.", 10*line, 2*line)
+        for n in range(10, 30):
+            spool.append({"n": n})
+        self.assertEqual(spool.evicted, 5)
+        self.assertEqual(sum(spool.sizes.values()), 10*line)
+        self.assertEqual([spool.pop()["n"] for i in range(10)], list(range(20, 30)))
+        self.assertIsNone(spool.pop())
+
+class KeepAliveTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config.update({"max_interval": 3600, "keepalive_tick": 60})
+        self.app = self.start()
+        self.announce("A0", "temperature")
+
+    def steady(self, hours, every=600):
+        for i in range(int(hours*3600/every)):
+            self.data("A0", "temperature", 20.0)
+            self.advance(every)
+
+    def test_a_sensor_that_has_gone_quiet_is_not_resent(self):
+        self.data("A0", "temperature", 20.0)
+        self.advance(24*3600)
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.0]})
+
+    def test_a_steady_sensor_is_resent_every_max_interval(self):
+        self.steady(3)
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.0]*3})
+        # Then goes quiet
+        self.advance(24*3600)
+        self.assertEqual(len(self.points()["BID0/Device_A0/temperature"]), 4)
+
+    def test_keepalive_tick_can_be_changed(self):
+        # Once an hour, on the first tick after the hour is up
+        for tick, count in ((600, 3), (1, 2)):
+            del self.sent[:]
+            self.app.onClientMessage({"config": {"keepalive_tick": tick}})
+            self.steady(2.5)
+            self.assertEqual(len(self.points()["BID0/Device_A0/temperature"]), count)
+
+class B1Decoder:
+    """ Decodes "b1" payloads from the layout described in BinaryEncoder """
+    def __init__(self):
+        self.names = []
+
+    def varint(self):
+        value = shift = 0
+        while True:
+            byte = self.data[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    def zigzag(self):
+        value = self.varint()
+        return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+    def decode(self, payload):
+        self.data = bytearray(payload)
+        assert self.data[0] == ds.BinaryEncoder.VERSION
+        self.offset = 1
+        base = self.varint()
+        d = []
+        for i in range(self.varint()):
+            number = self.varint()
+            if number & 1:
+                length = self.varint()
+                self.names.append(self.data[self.offset:self.offset + length].decode("utf-8"))
+                self.offset += length
+            name = self.names[number >> 1]
+            times = []
+            time = base
+            for j in range(self.varint()):
+                time += self.zigzag()
+                times.append(time)
+            values = struct.unpack_from("<%df" % len(times), bytes(self.data), self.offset)
+            self.offset += 4*len(times)
+            d.append({"name": name, "points": [[t, v] for t, v in zip(times, values)]})
+        assert self.offset == len(self.data)
+        return d
+
+class BinaryEncodingTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["wire_encoding"] = "binary"
+        self.app = self.start()
+        self.app.onClientMessage({"encoding": ds.BINARY_ENCODING})
+        self.announce("A0", "temperature", "humidity")
+        self.decoder = B1Decoder()
+
+    def send(self):
+        del self.sent[:]
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        [msg] = self.sent
+        if msg.get("e") == ds.BINARY_ENCODING:
+            return self.decoder.decode(base64.b64decode(msg["d"]))
+        return msg["d"]
+
+    def test_b1_layout(self):
+        self.data("A0", "temperature", 20.0, timeStamp=START + 5)
+        self.data("A0", "temperature", 21.5, timeStamp=START + 2)     # Behind the first
+        self.data("A0", "humidity", 50.0, timeStamp=START + 1.5)
+        self.assertEqual(self.send(),
+                         [{"name": "BID0/Device_A0/temperature", "points": [[(START + 5)*1000, 20.0],
+                                                                            [(START + 2)*1000, 21.5]]},
+                          {"name": "BID0/Device_A0/humidity", "points": [[(START + 1.5)*1000, 50.0]]}])
+        # Names already sent are referred to by number
+        self.data("A0", "humidity", 60.0, timeStamp=START + 10)
+        self.data("A0", "temperature", 22.0, timeStamp=START + 11)
+        self.assertEqual(self.send(),
+                         [{"name": "BID0/Device_A0/humidity", "points": [[(START + 10)*1000, 60.0]]},
+                          {"name": "BID0/Device_A0/temperature", "points": [[(START + 11)*1000, 22.0]]}])
+        self.assertNotIn(b"humidity", base64.b64decode(self.sent[-1]["d"]))
+
+    def test_values_that_are_not_numbers_are_sent_as_json(self):
+        self.app.dm.storeValues("BID0/Device_A0/state", START, "open", "state")
+        self.data("A0", "temperature", 20.0)
+        self.assertEqual(self.send(), [{"name": "BID0/Device_A0/state", "points": [[START*1000, "open"]]},
+                                       {"name": "BID0/Device_A0/temperature", "points": [[START*1000, 20.0]]}])
+        self.assertNotIn("e", self.sent[-1])
+        # Names in a message sent as JSON are sent again in the next binary one
+        self.data("A0", "temperature", 21.0, timeStamp=START + 20)
+        self.assertEqual(self.send(), [{"name": "BID0/Device_A0/temperature", "points": [[(START + 20)*1000, 21.0]]}])
+        self.assertIn(b"temperature", base64.b64decode(self.sent[-1]["d"]))
+
+class CompressionTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config.update({"compress_codec": "zlib", "compress_threshold": 500})
+        self.app = self.start()
+        self.announce("A0", "temperature")
+
+    def send(self, n):
+        """ Sends n temperatures in one batch and returns the message the client was sent """
+        del self.sent[:]
+        for i in range(n):
+            self.data("A0", "temperature", 20.0 + i, timeStamp=clock.now + i)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        [msg] = self.sent
+        return msg
+
+    def test_payloads_over_the_threshold_are_compressed(self):
+        msg = self.send(50)
+        self.assertEqual(sorted(msg), ["c", "d", "m"])
+        self.assertEqual(msg["c"], "zlib")
+        d = json.loads(zlib.decompress(base64.b64decode(msg["d"])).decode("utf-8"))
+        self.assertEqual(d, [{"name": "BID0/Device_A0/temperature",
+                              "points": [[(START + i)*1000, 20.0 + i] for i in range(50)]}])
+        stats = self.app.dm.compressionStats
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["compressed_bytes"], len(base64.b64decode(msg["d"])))
+        self.assertLess(stats["compressed_bytes"], stats["raw_bytes"])
+
+    def test_payloads_under_the_threshold_are_sent_as_they_are(self):
+        msg = self.send(2)
+        self.assertNotIn("c", msg)
+        self.assertEqual(len(msg["d"][0]["points"]), 2)
+        self.assertEqual(self.app.dm.compressionStats["batches"], 0)
+
+    def test_payloads_that_compression_makes_bigger_are_sent_as_they_are(self):
+        # A single point packs into fewer bytes than zlib's own overhead
+        ds.config.update({"wire_encoding": "binary", "compress_threshold": 1})
+        self.app.dm.configure()
+        self.app.onClientMessage({"encoding": ds.BINARY_ENCODING})
+        msg = self.send(1)
+        self.assertEqual(msg["e"], ds.BINARY_ENCODING)
+        self.assertNotIn("c", msg)
+        self.assertEqual(B1Decoder().decode(base64.b64decode(msg["d"])),
+                         [{"name": "BID0/Device_A0/temperature", "points": [[START*1000, 20.0]]}])
+        stats = self.app.dm.compressionStats
+        self.assertEqual(stats["batches"], 1)
+        self.assertGreater(stats["compressed_bytes"], stats["raw_bytes"])
+
+class AggregateTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config.update({"accel": True, "accel_mode": "aggregate", "accel_aggregate_window": 60,
+                          "aggregate_rms": True, "keepalive_tick": 60})
+        self.app = self.start()
+        self.announce("A0", "acceleration")
+        # Start on the second of a window
+        self.window = START - START % 60 + 60
+        self.advance(self.window + 1 - clock.now)
+
+    def accel(self, x, y, z):
+        self.data("A0", "acceleration", {"x": x, "y": y, "z": z})
+
+    def test_windows(self):
+        for x, y, z in ((1.0, -1.0, 0.0), (3.0, -2.0, 0.0), (2.0, -3.0, 0.0)):
+            self.accel(x, y, z)
+            self.advance(29)
+        # The next window's first sample sends the last window's statistics
+        self.accel(5.0, 5.0, 5.0)
+        self.advance(ds.config["data_send_delay_max"])
+        points = self.points(times=True)
+        t = self.window*1000
+        expected = {"x": (1.0, 3.0, 2.0, (14/3.0)**0.5), "y": (-3.0, -1.0, -2.0, (14/3.0)**0.5),
+                    "z": (0.0, 0.0, 0.0, 0.0)}
+        for axis, values in expected.items():
+            for stat, value in zip(("min", "max", "mean", "rms"), values):
+                [[time, v]] = points["BID0/Device_A0/accel/%s/%s" % (axis, stat)]
+                self.assertEqual(time, t)
+                self.assertAlmostEqual(v, value)
+        self.assertEqual(points["BID0/Device_A0/accel/count"], [[t, 3]])
+        self.assertEqual(len(points), 13)
+        # With no more samples, the keep-alive tick sends the second window once it is over
+        del self.sent[:]
+        self.advance(60 + ds.config["keepalive_tick"] + ds.config["data_send_delay_max"])
+        points = self.points(times=True)
+        self.assertEqual(points["BID0/Device_A0/accel/x/mean"], [[t + 60000, 5.0]])
+        self.assertEqual(points["BID0/Device_A0/accel/count"], [[t + 60000, 1]])
+
+class AdaptivePollingTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["adaptive_polling"] = True
+        self.app = self.start()
+        self.announce("A0", "temperature")
+        self.review = ds.config["polling_review_interval"]
+
+    def interval(self, values):
+        """ Sends values over a review interval and returns the polling interval then asked for """
+        del self.requests[:]
+        for v in values:
+            self.data("A0", "temperature", v)
+            self.advance(float(self.review)/len(values))
+        self.advance(1)
+        requests = [msg["service"] for destination, msg in self.requests if destination == "A0"]
+        return requests[-1][0]["interval"] if requests else None
+
+    def test_quiet_series_are_polled_less_often_up_to_the_max_factor(self):
+        self.assertEqual([self.interval([20.0]*20) for i in range(4)], [600, 1200, 2400, None])
+
+    def test_busy_series_are_polled_more_often_down_to_the_min_factor(self):
+        self.assertEqual([self.interval([20.0, 21.0]*10) for i in range(3)], [150, 75, None])
+
+    def test_series_in_between_are_left_alone(self):
+        # A quarter of the samples pass, and they vary by less than twice min_change
+        self.assertIsNone(self.interval([20.0]*4 + [20.1]*4 + [20.0]*4 + [20.1]*4 + [20.0]*4))
+        self.assertEqual(self.interval([20.0]*20), 600)
+        self.assertIsNone(self.interval([20.0]*4 + [20.1]*4 + [20.0]*4 + [20.1]*4 + [20.0]*4))
+        self.assertEqual(self.interval([20.0, 21.0]*10), 300)
+
+class FilterSnapshotTest(AppTestCase):
+    def setUp(self):
+        AppTestCase.setUp(self)
+        ds.config["accel"] = True
+        self.announce("A0", "temperature", "acceleration")
+        self.data("A0", "temperature", 20.0)
+        self.data("A0", "acceleration", {"x": 0.0, "y": 0.0, "z": 1.0})
+
+    def restart(self, after=1, stop=True, announce=True):
+        """ Stops the app and starts another after seconds, as a new process would """
+        if stop:
+            self.app.onStop()
+        clock.now += after
+        reactor.calls = []
+        del self.sent[:]
+        ds.filters = ds.DeadbandFilters()
+        self.app = self.start()
+        if announce:
+            self.announce("A0", "temperature", "acceleration")
+
+    def resent(self):
+        """ The points sent for the same readings as before the restart """
+        self.data("A0", "temperature", 20.0)
+        self.data("A0", "acceleration", {"x": 0.0, "y": 0.0, "z": 1.0})
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        return sorted(self.points())
+
+    def test_filters_carry_on_after_a_restart(self):
+        self.restart()
+        self.assertEqual(self.resent(), [])
+        self.data("A0", "temperature", 20.5)
+        self.advance(ds.config["data_send_delay_max"] + 1)
+        self.assertEqual(self.points(), {"BID0/Device_A0/temperature": [20.5]})
+
+    def test_states_for_adaptors_that_do_not_come_back_are_dropped(self):
+        self.restart(announce=False)
+        self.app.onStop()
+        self.assertEqual(len(ds.DeadbandFilters.unpack(open(ds.FILTERS_FILE, "rb").read())[1]), 2)
+        self.advance(ds.config["filter_snapshot_interval"])
+        self.assertEqual(ds.DeadbandFilters.unpack(open(ds.FILTERS_FILE, "rb").read())[1], {})
+
+    def test_snapshots_are_taken_every_interval(self):
+        self.advance(ds.config["filter_snapshot_interval"])
+        self.assertTrue(os.path.isfile(ds.FILTERS_FILE))
+        written, states = ds.DeadbandFilters.unpack(open(ds.FILTERS_FILE, "rb").read())
+        self.assertEqual(states, {"A0\ttemperature": ([20.0], True, START),
+                                  "A0\tacceleration": ([0.0, 0.0, 1.0], True, START)})
+
+    def test_corrupt_snapshots_are_ignored(self):
+        self.app.onStop()
+        with open(ds.FILTERS_FILE, "r+b") as f:
+            f.truncate(os.path.getsize(ds.FILTERS_FILE) - 1)
+        with self.assertLogs(level="WARNING") as logs:
+            self.restart(stop=False)
+        self.assertIn("Ignoring corrupt filter snapshot", "".join(logs.output))
+        self.assertEqual(len(self.resent()), 4)
+
+    def test_old_snapshots_are_ignored(self):
+        self.restart(after=ds.config["filter_snapshot_max_age"] + 1)
+        self.assertEqual(len(self.resent()), 4)
+
+    def test_states_of_the_wrong_width_are_ignored(self):
+        states = {"A0\tacceleration": ([1.0], True, START), "A0\ttemperature": ([20.0], True, START)}
+        ds.persistence.write(ds.FILTERS_FILE, ds.DeadbandFilters.pack(states, START))
+        self.restart(stop=False)
+        self.assertEqual(self.resent(), ["BID0/Device_A0/accel/x", "BID0/Device_A0/accel/y", "BID0/Device_A0/accel/z"])
+
+if __name__ == '__main__':
+    unittest.main()